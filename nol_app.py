@@ -1,54 +1,399 @@
 #!/usr/bin/env python3
 # vim: set ts=4 sts=4 sw=4 et:
 
-from nol_lib import NolCrawler
-from pprint import pprint
-from json import dumps
-from sys import argv, stderr
+from nol_lib import CacheMissError, Course, CourseDatabase, CrawlJournal, \
+    NolCrawler, ResponseCache
+from io import StringIO
+from pprint import pformat
+import bz2
+import csv
+import gzip
+import logging
+import lzma
+from json import dump, dumps, load, loads
+from os import replace
+from os.path import exists, splitext
+from urllib.parse import urlparse, parse_qs
+from sys import argv, stderr, stdout
+try:
+    from compression import zstd
+except ImportError:
+    zstd = None
 
-def update_progress(now, total):
+# 壓縮方式和對應的副檔名，zstd 需要 Python 3.14 以上
+compressors = {
+    'gzip': lambda f: gzip.GzipFile(fileobj=f, mode='wb'),
+    'bz2': lambda f: bz2.BZ2File(f, 'wb'),
+    'xz': lambda f: lzma.LZMAFile(f, 'wb'),
+}
+if zstd is not None:
+    compressors['zstd'] = lambda f: zstd.ZstdFile(f, 'wb')
+compression_exts = {'.gz': 'gzip', '.bz2': 'bz2', '.xz': 'xz', '.zst': 'zstd'}
+
+
+class OutputSink:
+    # 輸出的資料先累積在記憶體中，每 batch_size 筆才編碼並寫入一次。path 為
+    # None 時寫入 stdout，沒有指定壓縮方式時依照副檔名決定。
+    def __init__(self, path=None, compression=None, batch_size=256):
+        if compression is None and path is not None:
+            compression = compression_exts.get(splitext(path)[1])
+        if compression is not None and compression not in compressors:
+            raise Exception('Unsupported compression {}'.format(compression))
+        self.raw = stdout.buffer if path is None else open(path, 'wb')
+        if compression is None:
+            self.file = self.raw
+        else:
+            self.file = compressors[compression](self.raw)
+        self.batch_size = batch_size
+        self.buffer = list()
+
+    def format(self, record):
+        raise NotImplementedError
+
+    def write(self, record):
+        self.buffer.append(self.format(record))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.file.write(''.join(self.buffer).encode('utf-8'))
+            self.buffer = list()
+            # 沒有壓縮的 stdout 要馬上送出，接在後面的程式才看得到
+            if self.file is stdout.buffer:
+                self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.file is not self.raw:
+            self.file.close()
+        if self.raw is stdout.buffer:
+            self.raw.flush()
+        else:
+            self.raw.close()
+
+
+class JsonSink(OutputSink):
+    def format(self, record):
+        return dumps(record, ensure_ascii=False, sort_keys=True) + '\n'
+
+
+class PrettySink(OutputSink):
+    def format(self, record):
+        return pformat(record) + '\n'
+
+
+class CsvSink(OutputSink):
+    # 一筆課程一列，欄位固定是 .__index__. 和 Course.fields，不是字串的值
+    # （time_clsrom 、 not_found 等）以 JSON 表示
+    columns = ('.__index__.',) + Course.fields
+
+    def __init__(self, *args, **kwargs):
+        OutputSink.__init__(self, *args, **kwargs)
+        self.buffer.append(self.format_row(CsvSink.columns))
+
+    def format_row(self, values):
+        f = StringIO()
+        csv.writer(f).writerow(values)
+        return f.getvalue()
+
+    def format(self, record):
+        return self.format_row(['' if value is None else
+            value if isinstance(value, str) else
+            dumps(value, ensure_ascii=False)
+            for value in map(record.get, CsvSink.columns)])
+
+sinks = {'jsonl': JsonSink, 'csv': CsvSink, 'pretty': PrettySink}
+
+def update_progress(now, total, metrics):
+    # 除了進度以外也顯示處理速度、預估剩餘時間和重試次數
     percent = now / total * 100
-    hashes = int(percent / 2)
-    blanks = 50 - hashes
-    print('\r({:5d}/{:5d}) [{}{}] {:6.2f}%'.format(
-        now, total, '#' * hashes, ' ' * blanks, percent), end='', file=stderr)
+    result = metrics.snapshot()
+    rate = result['counters'].get('rows', 0) / result['elapsed']
+    remaining = int((total - now) / rate) if rate > 0 else 0
+    print('\r({:5d}/{:5d}) {:6.2f}% {:8.1f} rows/s ETA {:d}:{:02d}:{:02d} '
+          'retries {:d}'.format(now, total, percent, rate, remaining // 3600,
+            remaining // 60 % 60, remaining % 60,
+            result['counters'].get('retries', 0)), end='', file=stderr)
     stderr.flush()
 
+def pop_option(name, default):
+    try:
+        position = argv.index(name)
+    except ValueError:
+        return default
+    value = argv[position + 1]
+    del argv[position:position + 2]
+    return value
+
+def pop_flag(name):
+    try:
+        argv.remove(name)
+    except ValueError:
+        return False
+    return True
+
+def crawl(crawler, start_index, count):
+    last_error = None
+    def retry(index, e):
+        nonlocal last_error
+        if last_error != index:
+            print('', file=stderr)
+        last_error = index
+        print('Error at {}: {}'.format(index, str(e)), file=stderr)
+        return True
+
+    for index, course in crawler.iter_courses(start_index, count, retry):
+        if index % NolCrawler.items_per_page == 0:
+            update_progress(index, count, crawler.metrics)
+        # to_dict() 回傳新的 dict，加上 .__index__. 不會改到 cache 中的課程
+        course = course.to_dict()
+        course['.__index__.'] = index
+        yield course
+    update_progress(count, count, crawler.metrics)
+    print('', file=stderr)
+
+def print_retry(index, e):
+    print('\nError at {}: {}'.format(index, str(e)), file=stderr)
+    return True
+
+def crawl_journal(crawler, path, start_index, count, concurrency):
+    # 完成的頁面記錄在 path.journal 中，中斷後用同樣的參數重新執行就會略過已經
+    # 完成的頁面。全部完成後才依照順序合併寫入 path。
+    journal = CrawlJournal(path, crawler.semester, count)
+    items = NolCrawler.items_per_page
+    first = NolCrawler.get_cache_addr(start_index)
+    last = NolCrawler.get_cache_addr(count - 1)
+    done = journal.pages()
+    addrs = [addr for addr in range(first, last + 1) if addr not in done]
+    finished = len(done)
+    total = last - first + 1
+    for addr, courses in crawler.iter_pages(addrs, concurrency, print_retry):
+        results = list()
+        for index in range(max(addr * items, start_index),
+                           min((addr + 1) * items, count)):
+            course = courses[index % items].to_dict()
+            course.update({'.__index__.': index})
+            results.append(course)
+        journal.write_page(addr, results)
+        crawler.metrics.count('rows', len(results))
+        finished += 1
+        update_progress(min(finished * items, count), count, crawler.metrics)
+    print('', file=stderr)
+    journal.merge()
+
+def get_cached_page_size(response_cache, semester):
+    # 離線時 cache 中沒有偵測用的網頁（用固定的 --page-size 下載的），就使用
+    # cache 中這學期第一頁的 page_cnt，舊的 cache 沒有 page_cnt 則是 15
+    for url, body in response_cache.entries():
+        query = parse_qs(urlparse(url).query)
+        if query.get('current_sem') == [semester] and \
+            query.get('startrec') == ['0']:
+            return int(query.get('page_cnt', [15])[0])
+    return NolCrawler.items_per_page
+
+def load_snapshot(path, semester):
+    # 讀取之前的輸出檔，如果有 --snapshot 一起存下的頁面 digest，也把內容
+    # 完整的頁面整理成 NolCrawler.set_baseline 要的格式
+    with open(path, encoding='utf-8') as f:
+        courses = [loads(line) for line in f if line.strip() != '']
+    pages = dict()
+    if not exists(path + '.pages'):
+        return courses, pages
+    with open(path + '.pages', encoding='utf-8') as f:
+        info = load(f)
+    items = NolCrawler.items_per_page
+    if info['semester'] != semester or info['items_per_page'] != items:
+        return courses, pages
+    rows = dict()
+    for course in courses:
+        course = dict(course)
+        index = course.pop('.__index__.')
+        rows.setdefault(NolCrawler.get_cache_addr(index), dict())[index % items] = course
+    for addr, digest in info['pages'].items():
+        page = rows.get(int(addr), dict())
+        if len(page) == items:
+            pages[int(addr)] = (digest, [page[i] for i in range(items)])
+    return courses, pages
+
+def flush_pages(courses, sink):
+    # 每開始新的一頁就把前一頁的結果寫出去，輸出到 stdout 時不用等累積滿
+    # batch_size 筆
+    for course in courses:
+        if course['.__index__.'] % NolCrawler.items_per_page == 0:
+            sink.flush()
+        yield course
+
+def write_snapshot(courses, sink):
+    for course in courses:
+        sink.write(course)
+        yield course
+
+def write_sqlite(courses, db, semester, batch_size=1000):
+    # 每 batch_size 筆課程在一個交易中寫入資料庫
+    batch = list()
+    for course in courses:
+        batch.append(course)
+        if len(batch) >= batch_size:
+            db.insert(semester, batch)
+            batch = list()
+        yield course
+    db.insert(semester, batch)
+
 if __name__ == '__main__':
     try:
         argv.index('--help')
-        print('Usage: {} semester start_index'.format(argv[0]))
+        print('Usage: {} [--concurrency N] [--ceiba-cache FILE] '
+              '[--cache-dir DIR [--cache-ttl SECONDS] [--offline]] '
+              '[--rate N] [--log FILE] [--metrics FILE] [--journal OUTPUT_FILE] '
+              '[--page-size N|auto] '
+              '[--since OLD_FILE] [--snapshot NEW_FILE] [--sqlite DB_FILE] '
+              '[--output FILE] [--format jsonl|csv|pretty] '
+              '[--compress {}] '
+              'semester start_index'.format(argv[0],
+                '|'.join(sorted(compressors))))
         exit(0)
     except ValueError:
         pass
 
-    semester = argv[1] if len(argv) >= 2 else NolCrawler.get_default_semester()
+    concurrency = int(pop_option('--concurrency', 1))
+    ceiba_cache = pop_option('--ceiba-cache', None)
+    cache_dir = pop_option('--cache-dir', None)
+    cache_ttl = float(pop_option('--cache-ttl', 3600))
+    offline = pop_flag('--offline')
+    previous = pop_option('--since', None)
+    snapshot = pop_option('--snapshot', None)
+    rate = float(pop_option('--rate', NolCrawler.scheduler.rate))
+    log = pop_option('--log', None)
+    metrics = pop_option('--metrics', None)
+    journal = pop_option('--journal', None)
+    page_size = pop_option('--page-size', 'auto')
+    sqlite = pop_option('--sqlite', None)
+    output = pop_option('--output', None)
+    output_format = pop_option('--format', 'jsonl')
+    compression = pop_option('--compress', None)
+    # 重試的等待、斷路等決定以一行一個 JSON 的格式寫入記錄檔
+    if log:
+        logging.basicConfig(filename=log, level=logging.INFO,
+            format='%(message)s')
+    NolCrawler.scheduler.rate = rate
+    if cache_dir:
+        response_cache = ResponseCache(cache_dir, cache_ttl, offline)
+    else:
+        response_cache = None
     start_index = int(argv[2]) if len(argv) >= 3 else 0
-    pretty = True if len(argv) >= 4 else False
-    crawler = NolCrawler(semester)
-    count = NolCrawler.get_course_count(semester)
-
-    if count == 0:
-        print('No such semester', file=stderr)
+    # 第三個參數是舊的 pprint 輸出方式
+    if len(argv) >= 4:
+        output_format = 'pretty'
+    if output_format not in sinks:
+        print('Unknown format {}'.format(output_format), file=stderr)
         exit(1)
+    if compression is not None and compression not in compressors:
+        print('Unknown compression {}'.format(compression), file=stderr)
+        exit(1)
+    if output_format == 'csv' and previous:
+        print('--format csv cannot be used with --since', file=stderr)
+        exit(1)
+    try:
+        semester = argv[1] if len(argv) >= 2 else \
+            NolCrawler.get_default_semester(response_cache)
+        count = NolCrawler.get_course_count(semester, response_cache)
+        if count == 0:
+            print('No such semester', file=stderr)
+            exit(1)
 
-    for index in range(start_index, count):
-        if index % NolCrawler.items_per_page == 0:
-            update_progress(index, count)
-        first_error = True
-        while True:
+        # 每頁的課程數要在建立 NolCrawler 之前決定，之後所有的頁碼都以它計算
+        if page_size == 'auto':
             try:
-                course = crawler.get_course(index)
-                break
-            except Exception as e:
-                if first_error:
-                    print('', file=stderr)
-                first_error = False
-                print('Error at {}: {}'.format(index, str(e)), file=stderr)
-        course.update({'.__index__.': index})
-        if pretty:
-            pprint(course)
+                NolCrawler.items_per_page = NolCrawler.detect_items_per_page(
+                    semester, response_cache)
+            except CacheMissError:
+                NolCrawler.items_per_page = get_cached_page_size(
+                    response_cache, semester)
         else:
-            print(dumps(course, ensure_ascii=False, sort_keys=True))
-    update_progress(count, count)
-    print('', file=stderr)
+            # 用第一頁確認 nol 每頁真的給這麼多課程，之後的頁面缺項時只會補上
+            # not_found，不會再檢查
+            NolCrawler.items_per_page = int(page_size)
+            detected = NolCrawler.detect_items_per_page(semester,
+                response_cache, NolCrawler.items_per_page)
+            if detected != NolCrawler.items_per_page:
+                print('NOL returns {} courses per page, not {}'.format(
+                    detected, NolCrawler.items_per_page), file=stderr)
+                exit(1)
+    except CacheMissError as e:
+        print(e, file=stderr)
+        exit(1)
+    crawler = NolCrawler(semester, ceiba_cache=ceiba_cache,
+        readahead=concurrency if concurrency > 1 else 0,
+        response_cache=response_cache)
+
+    if journal:
+        if previous or snapshot or output:
+            print('--journal cannot be used with --since, --snapshot or '
+                '--output', file=stderr)
+            exit(1)
+        try:
+            crawl_journal(crawler, journal, start_index, count, concurrency)
+        except CacheMissError as e:
+            # 離線時 cache 中沒有的資料重試也拿不到
+            print('\n{}'.format(e), file=stderr)
+            exit(1)
+        if sqlite:
+            db = CourseDatabase(sqlite)
+            with open(journal, encoding='utf-8') as f:
+                for course in write_sqlite((loads(line) for line in f
+                                            if line.strip() != ''), db, semester):
+                    pass
+            db.close()
+        if metrics:
+            with open(metrics, 'w', encoding='utf-8') as f:
+                dump(crawler.get_metrics(), f, indent=2, sort_keys=True)
+        exit(0)
+
+    if previous:
+        old_courses, pages = load_snapshot(previous, semester)
+        old_courses = [course for course in old_courses
+                       if course['.__index__.'] >= start_index]
+        crawler.set_baseline(pages)
+    courses = crawl(crawler, start_index, count)
+    sink = sinks[output_format](output, compression)
+    snapshot_sink = None
+    db = None
+    # 中斷或發生錯誤時也要關閉輸出檔，已經下載的課程才不會留在緩衝區中，
+    # 壓縮檔也才是完整的
+    try:
+        if output is None:
+            courses = flush_pages(courses, sink)
+        if snapshot:
+            snapshot_sink = JsonSink(snapshot + '.tmp')
+            courses = write_snapshot(courses, snapshot_sink)
+        if sqlite:
+            db = CourseDatabase(sqlite)
+            courses = write_sqlite(courses, db, semester)
+        # 有 --since 時只輸出和之前的輸出檔不同的課程
+        if previous:
+            results = NolCrawler.diff_courses(old_courses, courses)
+        else:
+            results = courses
+        for result in results:
+            sink.write(result)
+    except CacheMissError as e:
+        print('\n{}'.format(e), file=stderr)
+        exit(1)
+    finally:
+        sink.close()
+        if snapshot_sink is not None:
+            snapshot_sink.close()
+        if db is not None:
+            db.close()
+    if snapshot:
+        with open(snapshot + '.pages', 'w', encoding='utf-8') as f:
+            dump({
+                'semester': semester,
+                'items_per_page': NolCrawler.items_per_page,
+                'pages': crawler.page_digests
+            }, f)
+        replace(snapshot + '.tmp', snapshot)
+    if metrics:
+        with open(metrics, 'w', encoding='utf-8') as f:
+            dump(crawler.get_metrics(), f, indent=2, sort_keys=True)
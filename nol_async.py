@@ -0,0 +1,316 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et:
+
+# asyncio 版本的 NolCrawler。async generator 和 asyncio.get_running_loop 需要
+# Python 3.7 以上，所以和 nol_lib 分開，其他程式在舊版 Python 仍然可以使用。
+
+from nol_lib import CacheMissError, NolCrawler, RequestScheduler
+from io import BytesIO
+from lxml import etree
+import asyncio
+import pycurl
+import time
+
+
+class AsyncCurlMulti:
+    # 用 asyncio 的 event loop 驅動 CurlMulti 的 socket 介面。libcurl 透過
+    # M_SOCKETFUNCTION 告訴我們要監看哪些 socket、透過 M_TIMERFUNCTION 要求逾時，
+    # 事件發生時再呼叫 socket_action，所有請求都在 event loop 的執行緒中進行。
+    def __init__(self, loop):
+        self.loop = loop
+        self.multi = pycurl.CurlMulti()
+        self.multi.setopt(pycurl.M_SOCKETFUNCTION, self.on_socket)
+        self.multi.setopt(pycurl.M_TIMERFUNCTION, self.on_timer)
+        self.futures = dict()
+        self.timer = None
+
+    def on_socket(self, event, fd, multi, data):
+        if event in (pycurl.POLL_IN, pycurl.POLL_INOUT):
+            self.loop.add_reader(fd, self.on_ready, fd, pycurl.CSELECT_IN)
+        else:
+            self.loop.remove_reader(fd)
+        if event in (pycurl.POLL_OUT, pycurl.POLL_INOUT):
+            self.loop.add_writer(fd, self.on_ready, fd, pycurl.CSELECT_OUT)
+        else:
+            self.loop.remove_writer(fd)
+
+    def on_timer(self, timeout):
+        # 不能在 libcurl 的 callback 中呼叫 socket_action，一律排到 event loop
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if timeout >= 0:
+            self.timer = self.loop.call_later(timeout / 1000,
+                self.on_ready, pycurl.SOCKET_TIMEOUT, 0)
+
+    def on_ready(self, fd, event):
+        if fd == pycurl.SOCKET_TIMEOUT:
+            self.timer = None
+        while self.multi.socket_action(fd, event)[0] == \
+            pycurl.E_CALL_MULTI_PERFORM:
+            pass
+        while True:
+            queued, ok_list, err_list = self.multi.info_read()
+            for curl in ok_list:
+                self.finish(curl, None)
+            for curl, errno, errmsg in err_list:
+                self.finish(curl, pycurl.error(errno, errmsg))
+            if queued == 0:
+                break
+
+    def finish(self, curl, error):
+        self.multi.remove_handle(curl)
+        future = self.futures.pop(curl)
+        if future.cancelled():
+            return
+        if error is None:
+            future.set_result(curl)
+        else:
+            future.set_exception(error)
+
+    async def perform(self, curl):
+        # 和 curl.perform() 一樣，只是等待時不會阻塞 event loop。被取消的話
+        # 請求也會跟著中止。
+        future = self.loop.create_future()
+        self.futures[curl] = future
+        self.multi.add_handle(curl)
+        try:
+            return await future
+        finally:
+            if self.futures.get(curl) is future:
+                del self.futures[curl]
+                self.multi.remove_handle(curl)
+
+    def close(self):
+        for curl, future in list(self.futures.items()):
+            self.multi.remove_handle(curl)
+            future.cancel()
+        self.futures = dict()
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        self.multi.close()
+
+
+class AsyncNolCrawler(NolCrawler):
+    # 在 asyncio 中使用的 NolCrawler，get_course、get_course_count 和
+    # iter_courses 都要 await。請求由 AsyncCurlMulti 在 event loop 中進行，多個
+    # 學期、多個頁面可以在同一個執行緒中同時下載；網頁分析、cache、scheduler
+    # 和 metrics 都和 NolCrawler 相同。頁面 cache 中存的是下載頁面的 Task，同一頁
+    # 同時只會下載一次。
+    def __init__(self, semester, concurrency=4, cache_size=5, **kwargs):
+        NolCrawler.__init__(self, semester,
+            cache_size=max(cache_size, concurrency + 1), **kwargs)
+        # 每個請求都從 curl_pool 另外拿 curl，NolCrawler 自己的 curl 用不到，
+        # 馬上放回去，不然每建立一個 AsyncNolCrawler 就會少一個
+        NolCrawler.release_curls([self.curl])
+        self.curl = None
+        self.concurrency = concurrency
+        self.multi = None
+
+    def get_multi(self):
+        # AsyncCurlMulti 要在第一次使用時才建立，才能拿到正在執行的 event loop
+        if self.multi is None:
+            self.multi = AsyncCurlMulti(asyncio.get_running_loop())
+        return self.multi
+
+    def close(self):
+        self.ceiba_cache.save()
+        if self.multi is not None:
+            self.multi.close()
+            self.multi = None
+
+    async def perform_async(self, curl, url):
+        # 和 NolCrawler.perform 相同，等待 scheduler 時也不阻塞 event loop
+        host = RequestScheduler.get_host(url)
+        delay = self.scheduler.reserve(host)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        try:
+            await self.get_multi().perform(curl)
+        except Exception as e:
+            self.scheduler.report(host, e)
+            raise
+        finally:
+            self.metrics.record_request(host, curl)
+        self.scheduler.observe(host, curl.getinfo(curl.TOTAL_TIME))
+
+    async def request_async(self, data, user_args, cache=None):
+        # 和 NolCrawler.request 相同，每個請求從 curl_pool 拿一個 curl
+        url = NolCrawler.get_url(user_args)
+        request_headers = []
+        headers = None
+        if cache is not None:
+            body, request_headers = cache.lookup(url)
+            self.metrics.count('response_cache_hits' if body is not None
+                               else 'response_cache_misses')
+            if body is not None:
+                data.write(body)
+                return None
+            headers = BytesIO()
+        curl = NolCrawler.acquire_curls(1, self.debug)[0]
+        try:
+            NolCrawler.prepare_request(curl, data, NolCrawler.ssl_cipher_nol,
+                user_args, None, headers, request_headers)
+            await self.perform_async(curl, url)
+            if cache is None:
+                NolCrawler.check_status(curl)
+                return None
+            if NolCrawler.finish_cached_request(cache, url, curl, data):
+                self.metrics.count('response_cache_revalidated')
+                return None
+            return headers
+        finally:
+            NolCrawler.release_curls([curl])
+
+    async def get_course_count(self):
+        if self.semester not in NolCrawler.metadata:
+            host = RequestScheduler.get_host(NolCrawler.base_url)
+            user_args = {'current_sem': self.semester}
+            data = BytesIO()
+            try:
+                headers = await self.request_async(data, user_args,
+                    self.response_cache)
+                data.seek(0)
+                html = etree.parse(data, self.get_parser())
+                if len(NolCrawler.xpath_tables(html)) == 0:
+                    raise Exception('NOL website down')
+            except pycurl.error:
+                raise
+            except Exception as e:
+                self.scheduler.report(host, e)
+                raise
+            self.scheduler.report(host)
+            NolCrawler.store_response(self.response_cache,
+                NolCrawler.get_url(user_args), data, headers)
+            NolCrawler.read_metadata(html, self.semester)
+        self.course_count = NolCrawler.metadata[self.semester]['count']
+        return self.course_count
+
+    async def fetch_page(self, addr):
+        # 和 NolCrawler.get_page 相同
+        host = RequestScheduler.get_host(NolCrawler.base_url)
+        user_args = self.get_page_args(addr)
+        data = BytesIO()
+        with self.metrics.timer('page'):
+            try:
+                with self.metrics.timer('request'):
+                    headers = await self.request_async(data, user_args,
+                        self.response_cache)
+                courses, ceiba_links = self.parse_page(addr, data)
+            except pycurl.error:
+                raise
+            except Exception as e:
+                self.scheduler.report(host, e)
+                raise
+            self.scheduler.report(host)
+            NolCrawler.store_response(self.response_cache,
+                NolCrawler.get_url(user_args), data, headers)
+            await self.fetch_ceiba(ceiba_links)
+        return courses
+
+    async def fetch_ceiba_link(self, link, limit):
+        async with limit:
+            url = NolCrawler.get_ceiba_url(link)
+            host = RequestScheduler.get_host(url)
+            headers = BytesIO()
+            curl = NolCrawler.acquire_curls(1, self.debug)[0]
+            try:
+                NolCrawler.prepare_request(curl, BytesIO(),
+                    NolCrawler.ssl_cipher_ceiba, url_override=url,
+                    headers=headers)
+                await self.perform_async(curl, url)
+                try:
+                    csn = NolCrawler.read_ceiba_location(curl, headers)
+                except Exception as e:
+                    self.scheduler.report(host, e)
+                    raise
+            finally:
+                NolCrawler.release_curls([curl])
+            self.scheduler.report(host)
+            return csn
+
+    async def fetch_ceiba(self, ceiba_links):
+        # 和 NolCrawler.resolve_ceiba 相同，同時進行的請求數量以 semaphore 限制
+        unresolved = self.get_unresolved_ceiba(ceiba_links)
+        if len(unresolved) > 0:
+            host = RequestScheduler.get_host(
+                NolCrawler.get_ceiba_url(unresolved[0]))
+            limit = asyncio.Semaphore(self.scheduler.get_concurrency(
+                host, self.ceiba_concurrency))
+            start_time = time.perf_counter()
+            try:
+                results = await asyncio.gather(*[
+                    self.fetch_ceiba_link(link, limit) for link in unresolved],
+                    return_exceptions=True)
+            finally:
+                self.metrics.add_time('ceiba', time.perf_counter() - start_time)
+            self.ceiba_cache.update({link: result for link, result in
+                zip(unresolved, results) if not isinstance(result, Exception)})
+            self.ceiba_cache.save_if_needed()
+            errors = [result for result in results
+                      if isinstance(result, Exception)]
+            if len(errors) > 0:
+                raise errors[0]
+        self.fill_ceiba(ceiba_links)
+
+    def start_page(self, addr):
+        # 失敗或被取消的頁面要從 cache 中移除，下次才會重新下載
+        task = asyncio.ensure_future(self.fetch_page(addr))
+
+        def done(task):
+            if task.cancelled() or task.exception() is not None:
+                self.cache.invalidate(addr)
+        task.add_done_callback(done)
+        return task
+
+    def get_page_task(self, addr):
+        return self.cache.load(addr, self.start_page, addr)
+
+    async def get_course(self, index):
+        if index < 0:
+            return None
+        # 呼叫者被取消時不要取消其他人也在等的 Task
+        courses = await asyncio.shield(
+            self.get_page_task(NolCrawler.get_cache_addr(index)))
+        return courses[index % NolCrawler.items_per_page]
+
+    async def iter_courses(self, start=0, stop=None, retry=None):
+        # 和 NolCrawler.iter_courses 相同，但同時會先開始下載後面的頁面，同時
+        # 下載的頁數最多是 concurrency，也受 scheduler 限制
+        if stop is None:
+            stop = await self.get_course_count()
+        index = max(start, 0)
+        last = NolCrawler.get_cache_addr(stop - 1)
+        host = RequestScheduler.get_host(NolCrawler.base_url)
+        # 結束或中斷時把還沒寫入的 CEIBA 查詢結果存起來
+        try:
+            while index < stop:
+                addr = NolCrawler.get_cache_addr(index)
+                window = self.scheduler.get_concurrency(host, self.concurrency)
+                for next_addr in range(addr, min(addr + window - 1, last) + 1):
+                    if not self.cache.contains(next_addr):
+                        self.get_page_task(next_addr)
+                try:
+                    courses = await asyncio.shield(self.get_page_task(addr))
+                except CacheMissError:
+                    raise
+                except Exception as e:
+                    if retry is None or not retry(index, e):
+                        raise
+                    self.metrics.count('retries')
+                    delay = self.scheduler.reserve(host)
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                    continue
+                page_stop = min((addr + 1) * NolCrawler.items_per_page, stop)
+                self.metrics.count('rows', page_stop - index)
+                for page_index in range(index, page_stop):
+                    yield page_index, \
+                        courses[page_index % NolCrawler.items_per_page]
+                index = page_stop
+        finally:
+            self.ceiba_cache.save()
+
+    def __aiter__(self):
+        return self.iter_courses()
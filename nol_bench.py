@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et:
+
+from nol_app import pop_option
+from nol_lib import CrawlMetrics, NolCrawler, RequestScheduler, ResponseCache, \
+    parse_time_clsrom
+from io import BytesIO
+from json import dumps, loads
+from os.path import abspath, dirname, join
+from subprocess import PIPE, Popen
+from urllib.parse import urlparse, parse_qs
+from sys import argv, executable, stderr
+import resource
+import time
+
+# 沒有指定 cache 目錄時使用的網頁，三種網頁格式各有一個學期
+default_cache_dir = join(dirname(abspath(__file__)), 'bench_cache')
+
+def get_era(semester):
+    # 不同學年度的網頁格式不同，分開計算才看得出是哪種格式變慢
+    sem_year, sem_index = map(int, semester.split('-'))
+    if sem_year >= 106 or (sem_year == 105 and sem_index >= 2):
+        return '105-2+'
+    elif sem_year >= 104:
+        return '104+'
+    else:
+        return 'pre-104'
+
+def load_pages(cache_dir):
+    pages = dict()
+    for url, body in ResponseCache(cache_dir, offline=True).entries():
+        query = parse_qs(urlparse(url).query)
+        if 'startrec' not in query:
+            continue
+        semester = query['current_sem'][0]
+        # 每頁的課程數記錄在網址的 page_cnt 中，舊的 cache 沒有則是 15
+        page_cnt = int(query.get('page_cnt', [15])[0])
+        addr = int(query['startrec'][0]) // page_cnt
+        pages.setdefault(get_era(semester), []).append(
+            (semester, addr, body, page_cnt))
+    return pages
+
+def bench_parse(cache_dir, repeat, min_rate):
+    pages = load_pages(cache_dir)
+    if len(pages) == 0:
+        print('No recorded pages in {}'.format(cache_dir), file=stderr)
+        return False
+    crawlers = dict()
+    passed = True
+    for era in sorted(pages):
+        rows = 0
+        start = time.perf_counter()
+        for i in range(repeat):
+            for semester, addr, body, page_cnt in pages[era]:
+                if semester not in crawlers:
+                    crawlers[semester] = NolCrawler(semester, ceiba=False)
+                courses, ceiba_links = crawlers[semester].parse_page(
+                    addr, BytesIO(body))
+                rows += len([c for c in courses if not c.get('not_found')])
+        elapsed = time.perf_counter() - start
+        rate = rows / elapsed
+        print('{:8s} {:6d} pages {:8d} rows {:8.3f} s {:10.1f} rows/sec'.format(
+            era, len(pages[era]) * repeat, rows, elapsed, rate))
+        if min_rate is not None and rate < min_rate:
+            print('{}: {:.1f} rows/sec is below {:.1f}'.format(
+                era, rate, min_rate), file=stderr)
+            passed = False
+    return passed
+
+def start_replay(cache_dir, ceiba_cache, latency, error_rate):
+    # 在另一個行程執行 nol_replay.py，伺服器用的記憶體和 CPU 才不會算進測量
+    # 結果中。它輸出的第一行是伺服器的網址。
+    args = [executable, join(dirname(abspath(__file__)), 'nol_replay.py'),
+            '--port', '0', '--latency', str(latency),
+            '--error-rate', str(error_rate)]
+    if ceiba_cache:
+        args += ['--ceiba-cache', ceiba_cache]
+    process = Popen(args + [cache_dir], stdout=PIPE)
+    url = process.stdout.readline().decode('ascii').strip()
+    if url == '':
+        process.wait()
+        raise Exception('nol_replay.py failed to start')
+    return process, url
+
+def bench_crawl(cache_dir, semester, ceiba_cache, concurrency, latency,
+                error_rate, min_rate):
+    # 對 nol_replay.py 下載整個學期，測量花費的時間、每秒的課程數和請求數，
+    # 以及行程的最高記憶體用量。沒有指定學期時測量 cache 中所有的學期。
+    # 每頁的課程數使用錄下來的網頁的 page_cnt
+    page_sizes = {s: page_cnt for era in load_pages(cache_dir).values()
+                  for s, addr, body, page_cnt in era}
+    if semester is None:
+        semesters = sorted(page_sizes)
+    else:
+        semesters = [semester]
+    if len(semesters) == 0:
+        print('No recorded pages in {}'.format(cache_dir), file=stderr)
+        return False
+    process, url = start_replay(cache_dir, ceiba_cache, latency, error_rate)
+    NolCrawler.base_url = url + urlparse(NolCrawler.base_url).path
+    NolCrawler.ceiba_url = url
+    # 測量的是 NolCrawler 本身的速度，所以不限制請求的速度
+    NolCrawler.scheduler = RequestScheduler(rate=None)
+    total_rows = 0
+    total_requests = 0
+    total_elapsed = 0
+    try:
+        for semester in semesters:
+            metrics = CrawlMetrics()
+            NolCrawler.items_per_page = page_sizes.get(semester,
+                NolCrawler.items_per_page)
+            crawler = NolCrawler(semester, ceiba=ceiba_cache is not None,
+                readahead=concurrency, metrics=metrics)
+            start = time.perf_counter()
+            rows = 0
+            for index, course in crawler.iter_courses(retry=lambda i, e: True):
+                rows += 1
+            elapsed = time.perf_counter() - start
+            requests = sum(request['count'] for request in
+                           metrics.snapshot()['requests'].values())
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            print('{:8s} {:8d} rows {:8.3f} s {:10.1f} rows/sec '
+                  '{:8.1f} req/sec {:8.1f} MB peak RSS'.format(semester, rows,
+                    elapsed, rows / elapsed, requests / elapsed, peak))
+            total_rows += rows
+            total_requests += requests
+            total_elapsed += elapsed
+    finally:
+        process.terminate()
+        process.wait()
+    rate = total_rows / total_elapsed
+    print('{:8s} {:8d} rows {:8.3f} s {:10.1f} rows/sec '
+          '{:8.1f} req/sec {:8.1f} MB peak RSS'.format('total', total_rows,
+            total_elapsed, rate, total_requests / total_elapsed, peak))
+    if min_rate is not None and rate < min_rate:
+        print('{:.1f} rows/sec is below {:.1f}'.format(rate, min_rate),
+            file=stderr)
+        return False
+    return True
+
+def check_time_clsrom(paths, semester):
+    # 用目前的程式重新分析檔案中每一筆 PRIVATE____time_clsrom，確認結果和檔案
+    # 中的 time_clsrom 相同。檔案可以是 nol_app.py 的輸出或是附帶的測試資料，
+    # 測試資料每一筆都有 semester，預期會分析失敗的則標示 error。
+    count = 0
+    mismatch = 0
+    for path in paths:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if line.strip() == '':
+                    continue
+                course = loads(line)
+                if 'PRIVATE____time_clsrom' not in course:
+                    continue
+                text = course['PRIVATE____time_clsrom']
+                sem_year = int(course.get('semester', semester).split('-')[0])
+                try:
+                    result = loads(dumps(parse_time_clsrom(sem_year >= 104, text)))
+                except Exception:
+                    result = None
+                expected = None if course.get('error') else course['time_clsrom']
+                count += 1
+                if result != expected:
+                    mismatch += 1
+                    print('{}: {!r} -> {!r} (expected {!r})'.format(
+                        path, text, result, expected), file=stderr)
+    print('{} checked, {} mismatched'.format(count, mismatch))
+    return mismatch == 0
+
+if __name__ == '__main__':
+    try:
+        argv.index('--help')
+        print('Usage: {0} parse [CACHE_DIR] [--repeat N] '
+              '[--min-rows-per-sec RATE]\n'
+              '       {0} crawl [CACHE_DIR] [--semester SEMESTER] '
+              '[--concurrency N] [--ceiba-cache FILE] [--latency SECONDS] '
+              '[--error-rate P] [--min-rows-per-sec RATE]\n'
+              '       {0} timecheck [--semester SEMESTER] FILE...'.format(argv[0]))
+        exit(0)
+    except ValueError:
+        pass
+
+    repeat = int(pop_option('--repeat', 10))
+    min_rate = pop_option('--min-rows-per-sec', None)
+    min_rate = float(min_rate) if min_rate is not None else None
+    semester = pop_option('--semester', None)
+    concurrency = int(pop_option('--concurrency', 4))
+    ceiba_cache = pop_option('--ceiba-cache', None)
+    latency = float(pop_option('--latency', 0))
+    error_rate = float(pop_option('--error-rate', 0))
+    command = argv[1] if len(argv) >= 2 else None
+    cache_dir = argv[2] if len(argv) >= 3 else default_cache_dir
+
+    if command == 'parse':
+        passed = bench_parse(cache_dir, repeat, min_rate)
+    elif command == 'crawl':
+        passed = bench_crawl(cache_dir, semester, ceiba_cache, concurrency,
+            latency, error_rate, min_rate)
+    elif command == 'timecheck' and len(argv) >= 3:
+        passed = check_time_clsrom(argv[2:], semester)
+    else:
+        print('Unknown command, see --help', file=stderr)
+        passed = False
+    exit(0 if passed else 1)
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et:
+
+from nol_app import JsonSink, pop_option
+from nol_lib import NolCrawler, ResponseCache
+from hashlib import sha1
+from json import dump, load
+from multiprocessing import Pool
+from os import listdir, makedirs, remove, replace, rmdir
+from os.path import exists, join
+from sys import argv, stderr
+
+def get_semester_key(semester):
+    # 學年度有兩位數也有三位數，要轉成數字比較，字串比較的話 99-1 會排在
+    # 105-1 後面
+    year, term = semester.split('-')
+    return int(year), int(term)
+
+def get_semester_list(specs, available):
+    # 學期可以直接列出，也可以用 103-1..105-2 表示範圍，all 表示所有學期
+    semesters = list()
+    for spec in specs:
+        if spec == 'all':
+            semesters += available
+        elif '..' in spec:
+            first, last = map(get_semester_key, spec.split('..'))
+            semesters += [s for s in available
+                          if first <= get_semester_key(s) <= last]
+        else:
+            semesters.append(spec)
+    return sorted(set(semesters), key=get_semester_key)
+
+def get_shard_path(out_dir, semester, start, stop):
+    return join(out_dir, semester, '{:06d}-{:06d}.jsonl'.format(start, stop))
+
+def crawl_unit(unit):
+    # 在子行程中下載一段課程，寫入自己的分段檔案。檔案寫完才改名，所以存在的
+    # 分段檔案一定是完整的，重新執行時可以直接略過。
+    if unit['cache_dir']:
+        response_cache = ResponseCache(unit['cache_dir'], unit['cache_ttl'])
+    else:
+        response_cache = None
+    NolCrawler.items_per_page = unit['items_per_page']
+    crawler = NolCrawler(unit['semester'], ceiba_cache=unit['ceiba_cache'],
+        readahead=unit['concurrency'], response_cache=response_cache)
+    crawler.course_count = unit['count']
+
+    def retry(index, e):
+        print('Error at {} {}: {}'.format(unit['semester'], index, str(e)),
+            file=stderr)
+        return True
+
+    path = unit['path']
+    sink = JsonSink(path + '.tmp')
+    for index, course in crawler.iter_courses(unit['start'], unit['stop'], retry):
+        course = course.to_dict()
+        course['.__index__.'] = index
+        sink.write(course)
+    sink.close()
+    replace(path + '.tmp', path)
+    return unit
+
+def merge_semester(out_dir, semester, units):
+    # 一個學期的分段都完成後，依照順序合併成一個檔案並記錄在 manifest 中
+    path = join(out_dir, semester + '.jsonl')
+    digest = sha1()
+    lines = 0
+    with open(path + '.tmp', 'wb') as f:
+        for unit in sorted(units, key=lambda u: u['start']):
+            with open(unit['path'], 'rb') as shard:
+                data = shard.read()
+            f.write(data)
+            digest.update(data)
+            lines += data.count(b'\n')
+    replace(path + '.tmp', path)
+    for unit in units:
+        remove(unit['path'])
+    if len(listdir(join(out_dir, semester))) == 0:
+        rmdir(join(out_dir, semester))
+    return {
+        'file': semester + '.jsonl',
+        'count': lines,
+        'sha1': digest.hexdigest()
+    }
+
+if __name__ == '__main__':
+    try:
+        argv.index('--help')
+        print('Usage: {} [--processes N] [--chunk-pages N] [--concurrency N] '
+              '[--page-size N|auto] [--ceiba-cache FILE] '
+              '[--cache-dir DIR [--cache-ttl SECONDS]] '
+              'output_dir semester...'.format(argv[0]))
+        exit(0)
+    except ValueError:
+        pass
+
+    processes = int(pop_option('--processes', 4))
+    chunk_pages = pop_option('--chunk-pages', None)
+    page_size = pop_option('--page-size', 'auto')
+    concurrency = int(pop_option('--concurrency', 2))
+    ceiba_cache = pop_option('--ceiba-cache', None)
+    cache_dir = pop_option('--cache-dir', None)
+    cache_ttl = float(pop_option('--cache-ttl', 3600))
+    if len(argv) < 3:
+        print('Usage: {} output_dir semester...'.format(argv[0]), file=stderr)
+        exit(1)
+    out_dir = argv[1]
+    makedirs(out_dir, exist_ok=True)
+
+    if cache_dir:
+        response_cache = ResponseCache(cache_dir, cache_ttl)
+    else:
+        response_cache = None
+    specs = argv[2:]
+    if any(spec == 'all' or '..' in spec for spec in specs):
+        available = NolCrawler.get_semesters(response_cache)
+    else:
+        available = list()
+    semesters = get_semester_list(specs, available)
+
+    manifest_path = join(out_dir, 'manifest.json')
+    if exists(manifest_path):
+        with open(manifest_path, encoding='utf-8') as f:
+            manifest = load(f)
+    else:
+        manifest = {'semesters': dict()}
+
+    counts = dict()
+    for semester in semesters:
+        if semester in manifest['semesters'] and \
+            exists(join(out_dir, manifest['semesters'][semester]['file'])):
+            continue
+        count = NolCrawler.get_course_count(semester, response_cache)
+        if count == 0:
+            print('No such semester {}'.format(semester), file=stderr)
+            continue
+        counts[semester] = count
+
+    # 每頁的課程數用課程最多的學期偵測，所有學期和子行程都使用同樣的數量。
+    # 課程數量比上限少的學期偵測不出上限。
+    # 指定的數量也用同一個學期的第一頁確認一次
+    if page_size != 'auto':
+        NolCrawler.items_per_page = int(page_size)
+        if len(counts) > 0:
+            detected = NolCrawler.detect_items_per_page(
+                max(counts, key=counts.get), response_cache,
+                NolCrawler.items_per_page)
+            if detected != NolCrawler.items_per_page:
+                print('NOL returns {} courses per page, not {}'.format(
+                    detected, NolCrawler.items_per_page), file=stderr)
+                exit(1)
+    elif len(counts) > 0:
+        NolCrawler.items_per_page = NolCrawler.detect_items_per_page(
+            max(counts, key=counts.get), response_cache)
+
+    # 每個學期切成數段，每段 chunk_pages 頁，分給不同的行程下載。沒有指定時每段
+    # 大約 300 門課。已經合併完成的學期會直接略過，要重新下載就先刪掉該學期的
+    # 輸出檔。
+    if chunk_pages is None:
+        chunk_pages = max(1, 300 // NolCrawler.items_per_page)
+    chunk = int(chunk_pages) * NolCrawler.items_per_page
+    pending = dict()
+    units = list()
+    for semester, count in sorted(counts.items(),
+            key=lambda item: get_semester_key(item[0])):
+        makedirs(join(out_dir, semester), exist_ok=True)
+        pending[semester] = list()
+        for start in range(0, count, chunk):
+            stop = min(start + chunk, count)
+            unit = {
+                'semester': semester,
+                'start': start,
+                'stop': stop,
+                'count': count,
+                'path': get_shard_path(out_dir, semester, start, stop),
+                'concurrency': concurrency,
+                'items_per_page': NolCrawler.items_per_page,
+                'ceiba_cache': ceiba_cache,
+                'cache_dir': cache_dir,
+                'cache_ttl': cache_ttl
+            }
+            pending[semester].append(unit)
+            if not exists(unit['path']):
+                units.append(unit)
+
+    def finish(semester):
+        manifest['semesters'][semester] = merge_semester(
+            out_dir, semester, pending.pop(semester))
+        with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+            dump(manifest, f, ensure_ascii=False, indent=2, sort_keys=True)
+        replace(manifest_path + '.tmp', manifest_path)
+        print('{} done'.format(semester), file=stderr)
+
+    remaining = {s: len([u for u in units if u['semester'] == s]) for s in pending}
+    for semester in [s for s in remaining if remaining[s] == 0]:
+        finish(semester)
+    with Pool(processes) as pool:
+        done = 0
+        for unit in pool.imap_unordered(crawl_unit, units):
+            done += 1
+            print('({:5d}/{:5d}) {} {}-{}'.format(done, len(units),
+                unit['semester'], unit['start'], unit['stop']), file=stderr)
+            remaining[unit['semester']] -= 1
+            if remaining[unit['semester']] == 0:
+                finish(unit['semester'])
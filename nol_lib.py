@@ -1,35 +1,885 @@
 #!/usr/bin/env python3
 # vim: set ts=4 sts=4 sw=4 et:
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import lru_cache
 from io import BytesIO
 from lxml import etree
 from urllib.parse import urlencode, urlparse, parse_qs
+import gzip
+import hashlib
+import json
+import logging
+import os
 import pycurl
+import random
 import re
+import shutil
+import sqlite3
+import sys
+import threading
+import time
 
 
-class ReadCache:
+logger = logging.getLogger('nol_lib')
+
+
+def get_tmp_path(path):
+    # 多個行程或執行緒可能同時寫入同一個檔案，暫存檔名稱不能相同
+    return '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+
+
+class PageCache:
+    # LRU cache，size 是最多保存的頁數。會從多個執行緒存取，所以要上鎖。
     def __init__(self, size):
         self.size = size
+        self.lock = threading.Lock()
         self.reset()
 
+    def contains(self, addr):
+        with self.lock:
+            return addr in self.cache
+
     def invalidate(self, addr):
-        index = addr % self.size
-        if self.cache[index][0] and self.cache[index][1] == addr:
-            self.cache[index] = (False, None, None)
+        with self.lock:
+            self.cache.pop(addr, None)
 
     def load(self, addr, miss_func, user_data):
-        index = addr % self.size
-        if self.cache[index][0] and self.cache[index][1] == addr:
-            return self.cache[index][2]
+        with self.lock:
+            if addr in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(addr)
+                return self.cache[addr]
+            self.misses += 1
+        # 下載時不要佔住 lock，其他執行緒還是可以使用 cache
+        value = miss_func(user_data)
+        self.store(addr, value)
+        return value
+
+    def store(self, addr, value):
+        with self.lock:
+            self.cache[addr] = value
+            self.cache.move_to_end(addr)
+            while len(self.cache) > self.size:
+                self.cache.popitem(last=False)
+                self.evictions += 1
+
+    def reset(self):
+        with self.lock:
+            self.cache = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'size': len(self.cache),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class CeibaCache:
+    # 記錄 CEIBA 連結對應到的課程代碼，None 表示連結沒有對應的課程網頁。
+    # 有指定 path 時會存在硬碟上，之後的下載或其他學期都可以直接使用。每次
+    # save 都要重寫整個檔案，所以查到的結果累積 save_count 筆或超過
+    # save_interval 秒才由 save_if_needed 寫入，下載結束時再呼叫 save。
+    def __init__(self, path=None, save_interval=60, save_count=1000):
+        self.path = path
+        self.links = dict()
+        self.lock = threading.Lock()
+        self.save_interval = save_interval
+        self.save_count = save_count
+        self.unsaved = 0
+        self.save_time = time.time()
+        if path and os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                self.links = json.load(f)
+
+    def __contains__(self, link):
+        return link in self.links
+
+    def get(self, link):
+        return self.links[link]
+
+    def update(self, links):
+        with self.lock:
+            self.links.update(links)
+            self.unsaved += len(links)
+
+    def save_if_needed(self):
+        if self.unsaved >= self.save_count or (self.unsaved > 0 and
+                time.time() - self.save_time >= self.save_interval):
+            self.save()
+
+    def save(self):
+        if not self.path or self.unsaved == 0:
+            return
+        with self.lock:
+            self.unsaved = 0
+            self.save_time = time.time()
+            # 其他行程可能也寫入過同一個檔案，先合併它們查到的結果
+            if os.path.exists(self.path):
+                with open(self.path, encoding='utf-8') as f:
+                    links = json.load(f)
+                links.update(self.links)
+                self.links = links
+            tmp_path = get_tmp_path(self.path)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.links, f, ensure_ascii=False, separators=(',', ':'))
+            os.replace(tmp_path, self.path)
+
+
+class CacheMissError(Exception):
+    # 離線模式下 cache 裡沒有需要的資料，重試也不會成功，所以不交給 retry 處理
+    pass
+
+
+class ResponseCache:
+    # 把 nol 回應的原始內容壓縮後存在 path 目錄中，以正規化後的網址當作 key。
+    # ttl 秒內存入的資料會直接使用，過期的資料則要送出條件式請求確認是否有更
+    # 新。offline 模式下完全不連線，cache 裡沒有的資料會直接回報錯誤。
+    def __init__(self, path, ttl=3600, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.offline = offline
+        os.makedirs(path, exist_ok=True)
+
+    def get_path(self, url):
+        return os.path.join(self.path,
+            hashlib.sha1(url.encode('utf-8')).hexdigest() + '.gz')
+
+    def get_ceiba_cache_path(self):
+        # 沒有另外指定 ceiba_cache 時，CEIBA 連結的查詢結果也存在這個目錄中，
+        # 離線時才能完全使用 cache 中的資料
+        return os.path.join(self.path, 'ceiba.json')
+
+    def read(self, url):
+        path = self.get_path(url)
+        if not os.path.exists(path):
+            return None, None
+        return self.read_file(path)
+
+    def read_file(self, path):
+        with gzip.open(path, 'rb') as f:
+            meta = json.loads(f.readline().decode('utf-8'))
+            return meta, f.read()
+
+    def entries(self):
+        # 依序產生 cache 中所有的 (url, body)，用來重新分析或測試存下來的網頁
+        for name in sorted(os.listdir(self.path)):
+            if name.endswith('.gz'):
+                meta, body = self.read_file(os.path.join(self.path, name))
+                yield meta['url'], body
+
+    def write(self, url, meta, body):
+        path = self.get_path(url)
+        tmp_path = get_tmp_path(path)
+        with gzip.open(tmp_path, 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8') + b'\n')
+            f.write(body)
+        os.replace(tmp_path, path)
+
+    def lookup(self, url):
+        # 回傳 (body, request_headers)，body 不是 None 就不需要送出請求
+        meta, body = self.read(url)
+        if self.offline:
+            if meta is None:
+                raise CacheMissError(
+                    '{} is not in the response cache'.format(url))
+            return body, []
+        if meta is None:
+            return None, []
+        if time.time() - meta['time'] < self.ttl:
+            return body, []
+        request_headers = []
+        if meta['etag']:
+            request_headers.append('If-None-Match: ' + meta['etag'])
+        if meta['last_modified']:
+            request_headers.append('If-Modified-Since: ' + meta['last_modified'])
+        return None, request_headers
+
+    def store(self, url, body, response_headers):
+        self.write(url, {
+            'url': url,
+            'time': time.time(),
+            'etag': NolCrawler.get_http_header(response_headers, b'ETag'),
+            'last_modified': NolCrawler.get_http_header(
+                response_headers, b'Last-Modified')
+        }, body)
+
+    def revalidate(self, url):
+        # 伺服器回應 304 時更新存入時間，並回傳 cache 裡的內容
+        meta, body = self.read(url)
+        meta['time'] = time.time()
+        self.write(url, meta, body)
+        return body
+
+
+class CrawlJournal:
+    # 記錄已經下載完成的頁面，讓中斷的下載可以接續。每一頁的課程各自存成
+    # path.journal 目錄中的一個檔案，寫完才改名，所以存在的檔案一定是完整的，
+    # 頁面也不需要依照順序完成。全部完成後用 merge 依照頁碼合併成 path。檔案
+    # 在改名前都會先 fsync，當機後也不會留下內容不完整的頁面。
+    def __init__(self, path, semester, count):
+        self.path = path
+        self.dir = path + '.journal'
+        meta = {
+            'semester': semester,
+            'items_per_page': NolCrawler.items_per_page,
+            'count': count
+        }
+        meta_path = os.path.join(self.dir, 'journal.json')
+        os.makedirs(self.dir, exist_ok=True)
+        # 上次執行在寫入途中被中斷的話會留下暫存檔，裡面的資料不完整
+        for name in os.listdir(self.dir):
+            if name.endswith('.tmp'):
+                os.remove(os.path.join(self.dir, name))
+        if os.path.exists(meta_path):
+            with open(meta_path, encoding='utf-8') as f:
+                if json.load(f) != meta:
+                    raise Exception('{} belongs to a different crawl'.format(
+                        self.dir))
         else:
-            value = miss_func(user_data)
-            self.cache[index] = (True, addr, value)
-            return value
+            tmp_path = get_tmp_path(meta_path)
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(meta, f)
+                CrawlJournal.sync(f)
+            os.replace(tmp_path, meta_path)
+
+    @staticmethod
+    def sync(f):
+        f.flush()
+        os.fsync(f.fileno())
+
+    def get_page_path(self, addr):
+        return os.path.join(self.dir, 'page-{:06d}.jsonl'.format(addr))
+
+    def pages(self):
+        return set(int(name[5:11]) for name in os.listdir(self.dir)
+                   if name.startswith('page-') and name.endswith('.jsonl'))
+
+    def write_page(self, addr, courses):
+        path = self.get_page_path(addr)
+        tmp_path = get_tmp_path(path)
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            for course in courses:
+                f.write(json.dumps(course, ensure_ascii=False, sort_keys=True))
+                f.write('\n')
+            CrawlJournal.sync(f)
+        os.replace(tmp_path, path)
+
+    def merge(self):
+        # 合併後才刪除 journal，合併到一半中斷的話重新執行還可以再合併一次。
+        # 目錄中可能還有被中斷的暫存檔，所以整個目錄一起刪除。
+        tmp_path = get_tmp_path(self.path)
+        pages = sorted(self.pages())
+        with open(tmp_path, 'wb') as output:
+            for addr in pages:
+                with open(self.get_page_path(addr), 'rb') as f:
+                    output.write(f.read())
+            CrawlJournal.sync(output)
+        os.replace(tmp_path, self.path)
+        shutil.rmtree(self.dir)
+
+
+class RequestScheduler:
+    # 控制送到每個主機的請求。rate 是每秒最多送出的請求數，失敗時依連續失敗的
+    # 次數以指數增加等待時間並加上隨機的抖動。連續失敗 breaker_threshold 次時
+    # （通常是 NOL website down）斷路 breaker_cooldown 秒完全不送請求，之後試
+    # 送的請求又失敗的話斷路時間加倍。回應時間超過最快時的 slow_factor 倍時減
+    # 少同時進行的請求數量，恢復後再慢慢增加。每個決定都以 JSON 記錄在
+    # nol_lib logger 中。
+    def __init__(self, rate=20, backoff_base=1, backoff_max=300,
+                 breaker_threshold=5, breaker_cooldown=60, slow_factor=2):
+        self.rate = rate
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.slow_factor = slow_factor
+        self.hosts = dict()
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_host(url):
+        return urlparse(url).hostname
+
+    def get_state(self, host):
+        state = self.hosts.get(host)
+        if state is None:
+            state = {
+                'next_slot': 0,
+                'retry_at': 0,
+                'failures': 0,
+                'breaker': 'closed',
+                'cooldown': self.breaker_cooldown,
+                'latency': None,
+                'best_latency': None,
+                'samples': 0,
+                'concurrency': None,
+                'max_concurrency': None
+            }
+            self.hosts[host] = state
+        return state
+
+    def log(self, event, host, **fields):
+        fields.update({'event': event, 'host': host, 'time': time.time()})
+        logger.info(json.dumps(fields, sort_keys=True))
+
+    def acquire(self, host):
+        # 送出請求前呼叫，必要時等到可以送出為止
+        delay = self.reserve(host)
+        if delay > 0:
+            time.sleep(delay)
+
+    def reserve(self, host):
+        # 在 lock 中先保留送出請求的時段，多個執行緒同時呼叫也不會超過速度限制。
+        # 回傳要等待的秒數，由呼叫者自己等待。
+        with self.lock:
+            state = self.get_state(host)
+            now = time.time()
+            start = max(now, state['next_slot'], state['retry_at'])
+            if self.rate:
+                state['next_slot'] = start + 1 / self.rate
+            if state['retry_at'] > now:
+                self.log('wait', host, delay=round(start - now, 3),
+                    failures=state['failures'], breaker=state['breaker'])
+        return start - now
+
+    def report(self, host, error=None):
+        # 回報請求的結果，error 是 None 表示成功
+        with self.lock:
+            state = self.get_state(host)
+            if error is None:
+                if state['breaker'] != 'closed':
+                    self.log('close', host, failures=state['failures'])
+                elif state['failures'] > 0:
+                    self.log('recover', host, failures=state['failures'])
+                state['failures'] = 0
+                state['breaker'] = 'closed'
+                state['cooldown'] = self.breaker_cooldown
+                return
+            state['failures'] += 1
+            failures = state['failures']
+            if failures >= self.breaker_threshold:
+                if state['breaker'] == 'open':
+                    state['cooldown'] = min(state['cooldown'] * 2,
+                        max(self.backoff_max, self.breaker_cooldown))
+                state['breaker'] = 'open'
+                delay = state['cooldown']
+                self.log('open', host, delay=delay, failures=failures,
+                    error=str(error))
+            else:
+                delay = min(self.backoff_max,
+                    self.backoff_base * 2 ** (failures - 1))
+                delay = delay / 2 + random.uniform(0, delay / 2)
+                self.log('backoff', host, delay=round(delay, 3),
+                    failures=failures, error=str(error))
+            state['retry_at'] = max(state['retry_at'], time.time() + delay)
+
+    def observe(self, host, latency):
+        # 記錄一個請求花費的秒數。每累積和目前同時請求數量一樣多的樣本才調整
+        # 一次，避免還沒看到調整後的效果就又再調整。
+        with self.lock:
+            state = self.get_state(host)
+            if state['latency'] is None:
+                state['latency'] = latency
+            else:
+                state['latency'] = state['latency'] * 0.8 + latency * 0.2
+            if state['best_latency'] is None or \
+                state['latency'] < state['best_latency']:
+                state['best_latency'] = state['latency']
+            state['samples'] += 1
+            if state['concurrency'] is None or \
+                state['samples'] < state['concurrency']:
+                return
+            state['samples'] = 0
+            latency = state['latency']
+            best = state['best_latency']
+            if latency > best * self.slow_factor and state['concurrency'] > 1:
+                state['concurrency'] = max(1, state['concurrency'] // 2)
+                self.log('slowdown', host, concurrency=state['concurrency'],
+                    latency=round(latency, 3), best_latency=round(best, 3))
+            elif latency < best * (1 + self.slow_factor) / 2 and \
+                state['concurrency'] < state['max_concurrency']:
+                state['concurrency'] += 1
+                self.log('speedup', host, concurrency=state['concurrency'],
+                    latency=round(latency, 3), best_latency=round(best, 3))
+
+    def get_concurrency(self, host, requested):
+        # 回傳目前對這個主機可以同時進行的請求數量，不會超過 requested
+        with self.lock:
+            state = self.get_state(host)
+            if state['max_concurrency'] is None or \
+                requested > state['max_concurrency']:
+                state['max_concurrency'] = requested
+            if state['concurrency'] is None:
+                state['concurrency'] = requested
+            return max(1, min(requested, state['concurrency']))
+
+    def stats(self):
+        with self.lock:
+            return {host: {
+                'failures': state['failures'],
+                'breaker': state['breaker'],
+                'latency': state['latency'],
+                'concurrency': state['concurrency']
+            } for host, state in self.hosts.items()}
+
+
+class CrawlMetrics:
+    # 統計下載過程中每個階段花費的時間。requests 以主機分類，記錄 libcurl 各
+    # 階段的時間（都是從請求開始累計的秒數）和下載的位元組數；stages 記錄分析
+    # 網頁等各步驟的秒數；counters 則是 cache 命中、重試等次數。
+    curl_timings = (
+        ('namelookup', pycurl.NAMELOOKUP_TIME),
+        ('connect', pycurl.CONNECT_TIME),
+        ('appconnect', pycurl.APPCONNECT_TIME),
+        ('starttransfer', pycurl.STARTTRANSFER_TIME),
+        ('total', pycurl.TOTAL_TIME)
+    )
+    # SIZE_DOWNLOAD 已經 deprecated，舊版的 pycurl 才用它
+    if hasattr(pycurl, 'SIZE_DOWNLOAD_T'):
+        size_download = pycurl.SIZE_DOWNLOAD_T
+    else:
+        size_download = pycurl.SIZE_DOWNLOAD
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
 
     def reset(self):
-        # (valid, addr, value)
-        self.cache = [(False, None, None)] * self.size
+        with self.lock:
+            self.start_time = time.time()
+            self.requests = dict()
+            self.stages = dict()
+            self.counters = dict()
+
+    def record_request(self, host, curl):
+        timings = [(name, curl.getinfo(option))
+                   for name, option in CrawlMetrics.curl_timings]
+        size = curl.getinfo(CrawlMetrics.size_download)
+        with self.lock:
+            request = self.requests.get(host)
+            if request is None:
+                request = {'count': 0, 'bytes': 0, 'phases': {
+                    name: {'total': 0, 'max': 0}
+                    for name, option in CrawlMetrics.curl_timings}}
+                self.requests[host] = request
+            request['count'] += 1
+            request['bytes'] += int(size)
+            for name, seconds in timings:
+                phase = request['phases'][name]
+                phase['total'] += seconds
+                phase['max'] = max(phase['max'], seconds)
+
+    def add_time(self, stage, seconds):
+        with self.lock:
+            record = self.stages.get(stage)
+            if record is None:
+                record = {'count': 0, 'total': 0, 'max': 0}
+                self.stages[stage] = record
+            record['count'] += 1
+            record['total'] += seconds
+            record['max'] = max(record['max'], seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - start)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def snapshot(self):
+        # 回傳可以直接存成 JSON 的統計結果，平均值也一併算好
+        with self.lock:
+            requests = dict()
+            for host, request in self.requests.items():
+                count = request['count']
+                requests[host] = {
+                    'count': count,
+                    'bytes': request['bytes'],
+                    'phases': {name: {
+                        'total': phase['total'],
+                        'mean': phase['total'] / count,
+                        'max': phase['max']
+                    } for name, phase in request['phases'].items()}
+                }
+            stages = {stage: {
+                'count': record['count'],
+                'total': record['total'],
+                'mean': record['total'] / record['count'],
+                'max': record['max']
+            } for stage, record in self.stages.items()}
+            return {
+                'elapsed': time.time() - self.start_time,
+                'requests': requests,
+                'stages': stages,
+                'counters': dict(self.counters)
+            }
+
+
+# 時間教室欄位的分析。104 學年度前後的節次代號不同，兩種對照表都先準備好，
+# 節次代號到位置的對照也改用 dict 查詢。同一個學年度制度下很多課程的時間教室
+# 完全相同，所以結果依 (是否為 104 學年度以後, 原始文字) 記下來重複使用。
+def make_time_table(time_list):
+    return time_list, {time: index for index, time in enumerate(time_list)}
+
+
+time_tables = {
+    False: make_time_table(tuple('01234@56789ABCD')),
+    True: make_time_table(tuple('0123456789') + ('10',) + tuple('ABCD'))
+}
+time_week_chars = frozenset('0123456789 ,')
+time_day_chars = frozenset('一二三四五六日')
+
+
+def freeze_time_clsrom(result):
+    # 記下來的結果會被很多課程共用，所以要換成不能修改的 tuple，重複出現的星期、
+    # 節次和教室字串也都經過 intern
+    return tuple((sys.intern(day),
+                  tuple(map(sys.intern, time)) if isinstance(time, list) else time,
+                  sys.intern(clsrom))
+                 for day, time, clsrom in result)
+
+
+@lru_cache(maxsize=4096)
+def parse_time_clsrom(is_104_or_later, text):
+    # 開頭如果有第2,3,4,5,6 週之類的東西直接先拿掉
+    if text.startswith('第'):
+        prefix_begin = 1
+        prefix_end = text.find('週')
+        assert prefix_end > prefix_begin
+        for char in text[prefix_begin:prefix_end]:
+            assert char in time_week_chars
+        text = text[prefix_end + 1:]
+    result = list()
+    state = 3 # 一開始就有可能出現多餘括號
+    brackets = 0
+    time_list, time_index = time_tables[is_104_or_later]
+    time_dash = False # 可能會有像是 1-@ (等同 1234@) 這種表示法
+    day = clsrom = ''
+    unexpected_clsrom = ''
+    time = []
+    uncommitted_time = ''
+    for char in text:
+        if char.isspace():
+            continue
+        if brackets == 0 and state == 3 and char != '(':
+            state = 0
+        if state == 0: # day
+            assert char in time_day_chars
+            day = char
+            state += 1
+        elif state == 1: # time
+            # 104 學年度以後節課可能出現 10，所以一定都會用逗號分隔
+            if is_104_or_later:
+                if char == ',' or char == '(':
+                    if uncommitted_time != '':
+                        assert uncommitted_time in time_index
+                        time.append(uncommitted_time)
+                        uncommitted_time = ''
+                    if char == '(':
+                        brackets += 1
+                        state += 1
+                        continue
+                else:
+                    uncommitted_time += char
+            # 104 學年度以前的資料雖也改用逗號分隔，但是常常分得不
+            # 正確，造成像是 1,-,@、8,9,1,0、9,,,A 這類錯誤。因此
+            # 我們繼續使用舊的作法，忽略逗號。
+            else:
+                if char == ',':
+                    continue
+                if char == '-':
+                    time_dash = True
+                    assert uncommitted_time == ''
+                    continue
+                if char == '*':
+                    time.append('*')
+                    assert uncommitted_time == ''
+                    continue
+                if char == '(':
+                    brackets += 1
+                    state += 1
+                    uncommitted_time = ''
+                    continue
+                if char in time_index:
+                    if len(time) > 0:
+                        time_prev = time_index[time[-1]]
+                        if uncommitted_time == '':
+                            time_this = time_index[char]
+                        else:
+                            # 目前已知會出現兩位數的只有 10
+                            assert uncommitted_time + char == '10'
+                            # 重新對應回 A
+                            time_this = time_index['A']
+                            uncommitted_time = ''
+                        # 檢查我們是不是遇到兩位數的。不過要注意時
+                        # 間有可能沒排序，所以我們還是假設只可能出
+                        # 現 10。
+                        if time_this <= time_prev and char == '1':
+                            uncommitted_time += char
+                        else:
+                            if time_dash:
+                                assert len(time) == 1
+                                time_this += 1
+                                time = list(time_list[time_prev:time_this])
+                            else:
+                                time.append(time_list[time_this])
+                    else:
+                        time.append(char)
+                else:
+                    assert False
+        elif state == 2: # clsrom
+            if char == '(':
+                brackets += 1
+            elif char == ')':
+                brackets -= 1
+            if brackets > 0:
+                clsrom += char
+            elif brackets == 0:
+                result.append((day, time, clsrom))
+                day = clsrom = ''
+                time = []
+                state += 1
+            else:
+                assert False
+        elif state == 3: # 多餘括號裡的資料先保存起來
+            if char == '(':
+                if brackets > 0:
+                    unexpected_clsrom += char
+                brackets += 1
+            elif char == ')':
+                brackets -= 1
+                if brackets > 0:
+                    unexpected_clsrom += char
+            else:
+                if brackets > 0:
+                    unexpected_clsrom += char
+        else:
+            assert False
+    # 括號可能沒有配對，這時候我們要直接先送出結果，不經過 assert
+    if clsrom.endswith(')') and brackets > 0:
+        result.append((day, time, clsrom))
+        return freeze_time_clsrom(result)
+    # 可能沒有時間，只有教室，我們手動填空直接回傳
+    if day == '' and time == [] and clsrom == '' and \
+        unexpected_clsrom != '' and len(result) == 0:
+        result.append(('', '', unexpected_clsrom))
+        return freeze_time_clsrom(result)
+    # 如果教室全部都是「請洽系所辦」，那就從前面多出來的挖
+    if all(r[2] == '請洽系所辦' for r in result):
+        if unexpected_clsrom != '':
+            for i in range(0, len(result)):
+                result[i] = (result[i][0], result[i][1], unexpected_clsrom)
+    assert day == '' and time == [] and clsrom == '' and brackets == 0
+    return freeze_time_clsrom(result)
+
+
+class Course:
+    # 一門課程的資料。同時保存好幾個學期的課程時每門課一個 dict 太佔記憶體，所以
+    # 改用 __slots__，系所、教師等重複出現的字串都經過 intern，時間教室則直接使用
+    # parse_time_clsrom 記下來的 tuple。可以像 dict 一樣用欄位名稱存取，沒有設定
+    # 的欄位視為不存在，輸出時用 to_dict() 轉回原本的格式。
+    fields = (
+        'ser_no', 'PRIVATE____dptname', 'dpt_code', 'cou_code', 'credit',
+        'co_select', 'cou_cname', 'tea_cname', 'PRIVATE____teaid',
+        'PRIVATE____video', 'time_clsrom', 'PRIVATE____time_clsrom', 'sel_code',
+        'co_gmark', 'co_chg', 'comment', 'klass', 'PRIVATE____ceiba', 'not_found'
+    )
+    interned_fields = frozenset((
+        'PRIVATE____dptname', 'dpt_code', 'cou_code', 'cou_cname', 'tea_cname',
+        'PRIVATE____teaid', 'PRIVATE____time_clsrom', 'sel_code', 'co_gmark',
+        'klass'
+    ))
+    __slots__ = fields
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        if name not in Course.fields:
+            raise KeyError(name)
+        if name in Course.interned_fields and isinstance(value, str):
+            value = sys.intern(value)
+        setattr(self, name, value)
+
+    def __contains__(self, name):
+        return name in Course.fields and hasattr(self, name)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def get(self, name, default=None):
+        return getattr(self, name, default) if name in Course.fields else default
+
+    def keys(self):
+        return [name for name in Course.fields if hasattr(self, name)]
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.keys()]
+
+    def to_dict(self):
+        # 每次都回傳新的 dict，修改它不會影響 cache 裡的課程
+        course = dict(self.items())
+        if 'time_clsrom' in course:
+            course['time_clsrom'] = [
+                (day, list(time) if isinstance(time, tuple) else time, clsrom)
+                for day, time, clsrom in course['time_clsrom']]
+        return course
+
+    @staticmethod
+    def from_dict(course):
+        # 把 to_dict() 或是 JSON 輸出檔中的課程轉回 Course，輸出檔中的
+        # .__index__. 等不是課程欄位的資料會略過
+        if isinstance(course, Course):
+            return course
+        if course.get('not_found'):
+            return not_found_course
+        result = Course()
+        for name, value in course.items():
+            if name not in Course.fields:
+                continue
+            if name == 'time_clsrom':
+                value = freeze_time_clsrom(value)
+            result[name] = value
+        return result
+
+
+# 頁面中缺少的課程都共用這一個
+not_found_course = Course()
+not_found_course['not_found'] = True
+
+
+class CourseDatabase:
+    # 把課程存進 SQLite。時間教室拆成 (星期, 節次, 教室) 一列一列存在 slots 中，
+    # 教師、系所、課號和上課時間都有索引，查詢時不需要掃過整個輸出檔。課程完整的
+    # 內容以 nol_app.py 輸出的 JSON 格式存在 data 欄位。
+    schema = '''
+        CREATE TABLE IF NOT EXISTS courses (
+            id INTEGER PRIMARY KEY,
+            semester TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            ser_no TEXT,
+            cou_code TEXT,
+            klass TEXT,
+            dpt_code TEXT,
+            teaid TEXT,
+            data TEXT NOT NULL,
+            UNIQUE (semester, idx)
+        );
+        CREATE TABLE IF NOT EXISTS slots (
+            course_id INTEGER NOT NULL REFERENCES courses (id),
+            semester TEXT NOT NULL,
+            day TEXT,
+            period TEXT,
+            room TEXT
+        );
+        CREATE INDEX IF NOT EXISTS courses_teaid ON courses (teaid, semester);
+        CREATE INDEX IF NOT EXISTS courses_dpt_code ON courses (dpt_code, semester);
+        CREATE INDEX IF NOT EXISTS courses_cou_code ON courses (cou_code, semester);
+        CREATE INDEX IF NOT EXISTS slots_time ON slots (day, period, semester);
+        CREATE INDEX IF NOT EXISTS slots_room ON slots (room, day, period);
+        CREATE INDEX IF NOT EXISTS slots_course ON slots (course_id);
+    '''
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.executescript(CourseDatabase.schema)
+
+    def close(self):
+        self.db.close()
+
+    def insert(self, semester, courses):
+        # courses 的每一項是 (index, Course) 或是有 .__index__. 的 dict。同一個
+        # 學期同一個 index 的課程會被取代。整批在同一個交易中寫入，呼叫者可以
+        # 自己決定每批的大小。
+        rows = list()
+        slots = list()
+        for course in courses:
+            if isinstance(course, tuple):
+                index, course = course
+                course = Course.from_dict(course).to_dict()
+                course['.__index__.'] = index
+            if course.get('not_found'):
+                continue
+            rows.append((semester, course['.__index__.'], course.get('ser_no'),
+                course.get('cou_code'), course.get('klass'),
+                course.get('dpt_code'), course.get('PRIVATE____teaid'),
+                json.dumps(course, ensure_ascii=False, sort_keys=True)))
+            course_slots = list()
+            for day, periods, room in course.get('time_clsrom') or []:
+                # 沒有節次時 periods 是空字串，還是要記下教室
+                for period in periods or [None]:
+                    course_slots.append((day or None, period, room or None))
+            slots.append(course_slots)
+        with self.db:
+            self.db.executemany('''
+                DELETE FROM slots WHERE course_id IN
+                (SELECT id FROM courses WHERE semester = ? AND idx = ?)
+            ''', [(row[0], row[1]) for row in rows])
+            self.db.executemany(
+                'DELETE FROM courses WHERE semester = ? AND idx = ?',
+                [(row[0], row[1]) for row in rows])
+            for row, course_slots in zip(rows, slots):
+                course_id = self.db.execute('''
+                    INSERT INTO courses (semester, idx, ser_no, cou_code, klass,
+                        dpt_code, teaid, data) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', row).lastrowid
+                self.db.executemany('''
+                    INSERT INTO slots (course_id, semester, day, period, room)
+                    VALUES (?, ?, ?, ?, ?)
+                ''', [(course_id, semester) + slot for slot in course_slots])
+        return len(rows)
+
+    def query(self, sql, args):
+        # 回傳 (學期, 課程) 的清單，依學期和 index 排序
+        return [(semester, json.loads(data)) for semester, data in
+                self.db.execute(sql + ' ORDER BY courses.semester, courses.idx',
+                    args)]
+
+    def find_courses(self, semester=None, teaid=None, dpt_code=None,
+                     cou_code=None):
+        conditions = list()
+        args = list()
+        for column, value in (('semester', semester), ('teaid', teaid),
+                              ('dpt_code', dpt_code), ('cou_code', cou_code)):
+            if value is not None:
+                conditions.append('courses.{} = ?'.format(column))
+                args.append(value)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return self.query('SELECT semester, data FROM courses' + where, args)
+
+    def find_slot(self, semester=None, day=None, period=None, room=None):
+        # 查詢某個時間或某間教室的課程，沒有指定的條件不限制
+        conditions = list()
+        args = list()
+        for column, value in (('semester', semester), ('day', day),
+                              ('period', period), ('room', room)):
+            if value is not None:
+                conditions.append('slots.{} = ?'.format(column))
+                args.append(value)
+        where = ' WHERE ' + ' AND '.join(conditions) if conditions else ''
+        return self.query('''
+            SELECT courses.semester, courses.data FROM courses
+            WHERE courses.id IN (SELECT slots.course_id FROM slots{})
+        '''.format(where), args)
 
 
 class NolCrawler:
@@ -42,7 +892,19 @@ class NolCrawler:
         'cstype': '1'
     }
     doc_encoding = 'big5'
+    # 每頁的課程數以 page_cnt 參數指定，nol 預設是 15。detect_items_per_page
+    # 會以 max_items_per_page 測試 nol 實際接受的上限。
     items_per_page = 15
+    max_items_per_page = 1000
+    # 設定時 CEIBA 連結的查詢會改送到這個網址，例如 nol_replay.py 的伺服器，
+    # 連結的路徑和參數不變，查詢結果仍然以原本的連結記錄
+    ceiba_url = None
+
+    # 分析網頁時用到的 XPath 和 regex 都先編譯好，不要每一列重新編譯
+    xpath_rows = etree.XPath('/html/body/table[4]/tr[position() > 1]')
+    xpath_tables = etree.XPath('/html/body/table')
+    xpath_images = etree.XPath('.//img')
+    co_gmark_regex = re.compile('A[1-8]+\\**')
 
     # XXX: 臺大課程網有 TLS，但是只支援到 TLSv1.0，所以我們必須手動設定。
     # 這個常數只有在新版的 pycurl 才有定義，所以使用前得先檢查。
@@ -68,350 +930,866 @@ class NolCrawler:
     else:
         raise Exception('Unsupported TLS implementation')
 
+    # 所有 NolCrawler 和 static method 共用 DNS 和 TLS session，用過的 curl 也放
+    # 回 curl_pool 重複使用，連線留在 curl 中，避免每次都要重新做一次很慢的 TLS
+    # 交握
+    curl_share = None
+    curl_share_pid = None
+    curl_pool = []
+    curl_pool_lock = threading.Lock()
+
+    # 學期清單、目前學期和課程數量都在同一個網頁中，下載過就記下來
+    metadata = dict()
 
-    def __init__(self, semester, ceiba=True, debug=False, cache_size=5):
+    # 預設所有 NolCrawler 共用同一個 scheduler，速度限制才會對整個行程有效
+    scheduler = RequestScheduler()
+    metrics = CrawlMetrics()
+
+
+    def __init__(self, semester, ceiba=True, debug=False, cache_size=5,
+                 ceiba_cache=None, ceiba_concurrency=8, readahead=0,
+                 response_cache=None, scheduler=None, metrics=None):
         self.semester = semester
         self.ceiba = ceiba
-        self.cache = ReadCache(cache_size)
-        self.curl = pycurl.Curl()
-        self.curl.setopt(self.curl.SSLVERSION, NolCrawler.ssl_version)
-        self.curl.setopt(pycurl.VERBOSE, 1 if debug else 0)
-        self.parser = etree.HTMLParser(encoding=NolCrawler.doc_encoding)
+        self.debug = debug
+        # cache 至少要放得下目前這頁和預先下載的頁面
+        self.cache = PageCache(max(cache_size, readahead + 1))
+        if ceiba_cache is None and response_cache is not None:
+            ceiba_cache = response_cache.get_ceiba_cache_path()
+        self.ceiba_cache = CeibaCache(ceiba_cache)
+        self.ceiba_concurrency = ceiba_concurrency
+        self.response_cache = response_cache
+        if scheduler is not None:
+            self.scheduler = scheduler
+        if metrics is not None:
+            self.metrics = metrics
+        self.readahead = readahead
+        self.readahead_thread = None
+        self.readahead_pages = set()
+        self.last_addr = None
+        self.course_count = None
+        self.baseline = dict()
+        self.page_digests = dict()
+        self.curl = NolCrawler.acquire_curls(1, debug)[0]
+        self.sem_year, self.sem_index = map(int, semester.split('-'))
+        self.local = threading.local()
+
+    @staticmethod
+    def get_curl_share():
+        # fork 出來的子行程不能沿用父行程的連線，所以每個行程要各自建立
+        with NolCrawler.curl_pool_lock:
+            if NolCrawler.curl_share_pid != os.getpid():
+                share = pycurl.CurlShare()
+                share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+                share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+                # 不共用連線：libcurl 不支援在多個執行緒同時使用共用的連線，
+                # 背景預先下載和前景的下載會同時進行
+                NolCrawler.curl_share = share
+                NolCrawler.curl_share_pid = os.getpid()
+                NolCrawler.curl_pool = []
+            return NolCrawler.curl_share
+
+    @staticmethod
+    def new_curl(debug=False):
+        curl = pycurl.Curl()
+        curl.setopt(curl.SSLVERSION, NolCrawler.ssl_version)
+        curl.setopt(curl.SHARE, NolCrawler.get_curl_share())
+        curl.setopt(pycurl.VERBOSE, 1 if debug else 0)
+        return curl
 
     @staticmethod
-    def request(curl, data, cipher, user_args={}, url_override=None, expected_status=200):
+    def acquire_curls(count, debug=False):
+        # 從 curl_pool 拿出 count 個 curl，不夠就建立新的。同一個 curl 不能同時
+        # 在不同執行緒中使用，用完要以 release_curls 放回去。
+        NolCrawler.get_curl_share()
+        with NolCrawler.curl_pool_lock:
+            curls = NolCrawler.curl_pool[:count]
+            del NolCrawler.curl_pool[:count]
+        for curl in curls:
+            curl.setopt(pycurl.VERBOSE, 1 if debug else 0)
+        while len(curls) < count:
+            curls.append(NolCrawler.new_curl(debug))
+        return curls
+
+    @staticmethod
+    def release_curls(curls):
+        with NolCrawler.curl_pool_lock:
+            NolCrawler.curl_pool += curls
+
+    @staticmethod
+    def get_url(user_args={}, url_override=None):
+        if url_override:
+            return url_override
         args = dict(NolCrawler.base_args)
         args.update(user_args)
-        if url_override:
-            curl.setopt(curl.URL, url_override)
-        else:
-            curl.setopt(curl.URL, NolCrawler.base_url + '?' + urlencode(args))
+        # 參數依名稱排序，同樣的請求才會對應到同一個網址
+        return NolCrawler.base_url + '?' + urlencode(sorted(args.items()))
+
+    @staticmethod
+    def prepare_request(curl, data, cipher, user_args={}, url_override=None,
+                        headers=None, request_headers=[]):
+        curl.setopt(curl.URL, NolCrawler.get_url(user_args, url_override))
         curl.setopt(curl.SSL_CIPHER_LIST, cipher)
         curl.setopt(curl.WRITEDATA, data)
-        curl.perform()
+        curl.setopt(curl.HTTPHEADER, request_headers)
+        # curl 會重複使用，沒有要讀取標頭時也要清掉之前的設定
+        if headers is not None:
+            curl.setopt(curl.HEADERFUNCTION, headers.write)
+        else:
+            curl.unsetopt(curl.HEADERFUNCTION)
+
+    @staticmethod
+    def check_status(curl, expected_status=200):
         status = curl.getinfo(curl.RESPONSE_CODE)
         if status != expected_status:
             raise Exception(
                 'HTTP status {} (not {})'.format(status, expected_status))
 
     @staticmethod
-    def static_request(user_args):
-        curl = pycurl.Curl()
-        curl.setopt(curl.SSLVERSION, NolCrawler.ssl_version)
+    def request(curl, data, cipher, user_args={}, url_override=None,
+                expected_status=200, headers=None, cache=None, scheduler=None,
+                metrics=None):
+        # 有 cache 時，新下載的網頁不會馬上存入 cache，而是回傳回應的標頭，由
+        # 呼叫者確認網頁內容正確後再用 store_response 存入。nol 故障時也會回應
+        # 200，存進去的話之後的重試都只會拿到同一個故障的網頁。
+        url = NolCrawler.get_url(user_args, url_override)
+        request_headers = []
+        if cache is not None:
+            body, request_headers = cache.lookup(url)
+            if metrics is not None:
+                metrics.count('response_cache_hits' if body is not None
+                              else 'response_cache_misses')
+            if body is not None:
+                data.write(body)
+                return None
+            headers = BytesIO()
+        NolCrawler.prepare_request(curl, data, cipher, user_args, url_override,
+            headers, request_headers)
+        NolCrawler.perform(curl, url, scheduler, metrics)
+        if cache is None:
+            NolCrawler.check_status(curl, expected_status)
+            return None
+        if NolCrawler.finish_cached_request(cache, url, curl, data):
+            if metrics is not None:
+                metrics.count('response_cache_revalidated')
+            return None
+        return headers
+
+    @staticmethod
+    def perform(curl, url, scheduler=None, metrics=None):
+        # 請求的結果由呼叫者檢查後再用 scheduler.report 回報
+        host = RequestScheduler.get_host(url)
+        if scheduler is not None:
+            scheduler.acquire(host)
+        try:
+            curl.perform()
+        except Exception as e:
+            if scheduler is not None:
+                scheduler.report(host, e)
+            raise
+        finally:
+            if metrics is not None:
+                metrics.record_request(host, curl)
+        if scheduler is not None:
+            scheduler.observe(host, curl.getinfo(curl.TOTAL_TIME))
+
+    @staticmethod
+    def finish_cached_request(cache, url, curl, data):
+        # 條件式請求得到 304 時要改用 cache 裡的內容，這時回傳 True。其他情況
+        # 回傳 False，新的內容要等確認過才用 store_response 存入 cache。
+        if curl.getinfo(curl.RESPONSE_CODE) == 304:
+            data.write(cache.revalidate(url))
+            return True
+        NolCrawler.check_status(curl)
+        return False
+
+    @staticmethod
+    def store_response(cache, url, data, headers):
+        # headers 是 request 回傳的回應標頭，None 表示不需要存入
+        if cache is not None and headers is not None:
+            cache.store(url, data.getvalue(), headers.getvalue())
+
+    @staticmethod
+    def request_multi(curls, jobs, scheduler=None, metrics=None):
+        # 用 CurlMulti 同時送出多個請求，同時進行中的請求數量以 curls 的數量為
+        # 上限。jobs 是 (key, args) 的序列，args 是傳給 prepare_request 的參數，
+        # 每完成一個請求就 yield (key, args, curl, error)，error 為 None 表示連
+        # 線成功，HTTP 狀態碼則要由呼叫者自己用 curl 檢查。有 scheduler 時每個
+        # 請求都要等 scheduler 允許才送出，連線失敗也會直接回報。
+        multi = pycurl.CurlMulti()
+        jobs = iter(jobs)
+        idle = list(curls)
+        running = dict()
+        try:
+            while True:
+                while len(idle) > 0:
+                    job = next(jobs, None)
+                    if job is None:
+                        break
+                    curl = idle.pop()
+                    key, args = job
+                    if scheduler is not None:
+                        scheduler.acquire(RequestScheduler.get_host(
+                            NolCrawler.get_url(args.get('user_args', {}),
+                                args.get('url_override'))))
+                    NolCrawler.prepare_request(curl, **args)
+                    multi.add_handle(curl)
+                    running[curl] = job
+                if len(running) == 0:
+                    break
+                while multi.perform()[0] == pycurl.E_CALL_MULTI_PERFORM:
+                    pass
+                finished = False
+                while True:
+                    queued, ok_list, err_list = multi.info_read()
+                    done = [(curl, None) for curl in ok_list] + \
+                        [(curl, errmsg) for curl, errno, errmsg in err_list]
+                    for curl, error in done:
+                        multi.remove_handle(curl)
+                        key, args = running.pop(curl)
+                        finished = True
+                        host = RequestScheduler.get_host(
+                            NolCrawler.get_url(args.get('user_args', {}),
+                                args.get('url_override')))
+                        if metrics is not None:
+                            metrics.record_request(host, curl)
+                        if scheduler is not None:
+                            if error is None:
+                                scheduler.observe(host,
+                                    curl.getinfo(curl.TOTAL_TIME))
+                            else:
+                                scheduler.report(host, error)
+                        yield key, args, curl, error
+                        idle.append(curl)
+                    if queued == 0:
+                        break
+                # 沒有請求完成時才等待，等待時間以 libcurl 要求的逾時為準
+                timeout = multi.timeout()
+                if not finished and timeout != 0:
+                    multi.select(timeout / 1000 if timeout > 0 else 1.0)
+        finally:
+            for curl in running:
+                multi.remove_handle(curl)
+            multi.close()
+
+    @staticmethod
+    def get_http_header(header_bytes, header_name):
+        # 標頭名稱不分大小寫，HTTP/2 的回應會全部用小寫
+        header_prefix = header_name.lower() + b':'
+        for header_line in header_bytes.split(b'\n'):
+            if header_line.lower().startswith(header_prefix):
+                return header_line.split(b':', maxsplit=1)[1].strip().decode('ascii')
+
+    @staticmethod
+    def static_request(user_args, cache=None):
+        # 沒有任何表格的網頁是 nol 故障時的網頁，不能存入 cache
+        curl = NolCrawler.acquire_curls(1)[0]
         data = BytesIO()
         try:
-            NolCrawler.request(curl, data, NolCrawler.ssl_cipher_nol, user_args)
+            headers = NolCrawler.request(curl, data, NolCrawler.ssl_cipher_nol,
+                user_args, cache=cache, scheduler=NolCrawler.scheduler,
+                metrics=NolCrawler.metrics)
+            data.seek(0)
+            html = etree.parse(data,
+                etree.HTMLParser(encoding=NolCrawler.doc_encoding))
+            if len(NolCrawler.xpath_tables(html)) == 0:
+                raise Exception('NOL website down')
+        except pycurl.error:
+            raise
+        except Exception as e:
+            NolCrawler.scheduler.report(
+                RequestScheduler.get_host(NolCrawler.base_url), e)
+            raise
         finally:
-            curl.close()
-        data.seek(0)
-        return etree.parse(data, etree.HTMLParser(encoding=NolCrawler.doc_encoding))
+            NolCrawler.release_curls([curl])
+        NolCrawler.scheduler.report(RequestScheduler.get_host(NolCrawler.base_url))
+        NolCrawler.store_response(cache, NolCrawler.get_url(user_args), data,
+            headers)
+        return html
+
+    @staticmethod
+    def get_metadata(semester=None, cache=None):
+        # 沒有指定學期時下載的是目前這學期的網頁，所以也能得知目前學期和它的
+        # 課程數量。回傳 {'semesters', 'semester', 'count'}，結果會記下來。
+        if semester in NolCrawler.metadata:
+            return NolCrawler.metadata[semester]
+        user_args = {} if semester is None else {'current_sem': semester}
+        return NolCrawler.read_metadata(
+            NolCrawler.static_request(user_args, cache), semester)
 
     @staticmethod
-    def get_semesters():
-        html = NolCrawler.static_request({})
+    def read_metadata(html, semester):
         box = html.xpath('//select[@id="select_sem"]')[0]
-        opts = map(lambda x: x.get('value'), box.iterchildren(tag='option'))
-        return list(opts)
+        selected = box.xpath('option[@selected]')
+        info = {
+            'semesters': [opt.get('value') for opt in box.iterchildren(tag='option')],
+            'semester': selected[0].get('value') if len(selected) > 0 else semester,
+            'count': int(list(box.getnext())[0].text)
+        }
+        NolCrawler.metadata[semester] = info
+        if semester is None:
+            NolCrawler.metadata[info['semester']] = info
+        return info
 
     @staticmethod
-    def get_default_semester():
-        html = NolCrawler.static_request({})
-        opt = html.xpath('//select[@id="select_sem"]/option[@selected]')[0]
-        return opt.get('value')
+    def flush_metadata():
+        NolCrawler.metadata = dict()
 
     @staticmethod
-    def get_course_count(semester):
-        html = NolCrawler.static_request({'current_sem': semester})
-        box = html.xpath('//select[@id="select_sem"]')[0]
-        count = list(box.getnext())[0]
-        return int(count.text)
+    def get_semesters(cache=None):
+        if len(NolCrawler.metadata) > 0:
+            return list(next(iter(NolCrawler.metadata.values()))['semesters'])
+        return list(NolCrawler.get_metadata(None, cache)['semesters'])
+
+    @staticmethod
+    def get_default_semester(cache=None):
+        return NolCrawler.get_metadata(None, cache)['semester']
+
+    @staticmethod
+    def get_course_count(semester, cache=None):
+        return NolCrawler.get_metadata(semester, cache)['count']
+
+    @staticmethod
+    def detect_items_per_page(semester, cache=None, size=None):
+        # 要求 size 筆課程（預設 max_items_per_page），拿到的比這學期的課程數量
+        # 少就表示 nol 有上限，上限就是拿到的數量。不接受 page_cnt 的話會拿到沒
+        # 有課程的網頁，這時使用原本的 15 筆。回傳偵測到的數量，要自己設定
+        # items_per_page。指定 size 時回傳值和 size 不同就表示 nol 每頁給的課程
+        # 比較少，用 size 下載的話每頁都會少掉一些課程。
+        count = NolCrawler.get_course_count(semester, cache)
+        if size is None:
+            size = NolCrawler.max_items_per_page
+        html = NolCrawler.static_request({
+            'current_sem': semester,
+            'startrec': 0,
+            'page_cnt': size
+        }, cache)
+        rows = len(NolCrawler.xpath_rows(html))
+        if rows == 0:
+            return 15
+        if rows < min(count, size):
+            return rows
+        return size
 
     @staticmethod
     def get_cache_addr(index):
         return int(index / NolCrawler.items_per_page)
 
-    def get_course(self, index):
-        def make_course(row):
-            def raw(node):
-                return etree.tostring(node, encoding='utf-8').decode('utf-8')
-
-            def safe_str(x):
-                return '' if x is None else x.strip('\xa0')
-
-            def safe_int(x):
-                return 0 if safe_str(x) == '' else int(x)
-
-            def get_link(node):
-                children = list(node)
-                if len(children) == 0 or children[0].tag != 'a':
-                    return None
-                return children[0].get('href')
-
-            def get_link_text(node):
-                children = list(node)
-                if len(children) == 0:
-                    return ''
-                elif children[0].tag != 'a':
-                    return safe_str(node.text)
-                return safe_str(children[0].text)
-
-            def get_http_header(header_bytes, header_name):
-                for header_line in header_bytes.split(b'\n'):
-                    if header_line.startswith(header_name + b':'):
-                        return header_line.split(b':', maxsplit=1)[1].strip().decode('ascii')
-
-            cells = list(row)
-            course = dict()
-            sem_year, sem_index = map(int, self.semester.split('-'))
-
-            course['ser_no'] = safe_str(cells[0].text)
-            course['PRIVATE____dptname'] = safe_str(cells[1].text)
-            info_link = get_link(cells[4])
-            if info_link:
-                course['dpt_code'] = parse_qs(
-                    urlparse(info_link).query)['dpt_code'][0]
-            else:
-                course['dpt_code'] = None
+    @staticmethod
+    def get_course_key(course):
+        return (course.get('ser_no'), course.get('cou_code'), course.get('klass'))
 
-            course['cou_code'] = safe_str(cells[7].text)
-            if sem_year >= 106 or (sem_year == 105 and sem_index >= 2):
-                course['credit'] = float(cells[6].text)
-            else:
-                course['credit'] = safe_int(cells[6].text)
-
-            course['co_select'] = safe_int(cells[11].text)
-            course['cou_cname'] = get_link_text(cells[4])
-            course['tea_cname'] = get_link_text(cells[10])
-            tea_link = get_link(cells[10])
-            if tea_link:
-                tea_link_parsed = parse_qs(urlparse(tea_link).query)
-                assert tea_link_parsed['op'][0] == 's2'
-                course['PRIVATE____teaid'] = tea_link_parsed['td'][0]
-            else:
-                course['PRIVATE____teaid'] = None
-
-            course['PRIVATE____video'] = get_link(cells[5])
-
-            def read_time_clsrom(text):
-                # 開頭如果有第2,3,4,5,6 週之類的東西直接先拿掉
-                if text.startswith('第'):
-                    prefix_begin = 1
-                    prefix_end = text.find('週')
-                    assert prefix_end > prefix_begin
-                    for char in text[prefix_begin:prefix_end]:
-                        assert char in list('0123456789') + [' ', ',']
-                    text = text[prefix_end + 1:]
-                text_len = len(text)
-                result = list()
-                state = 3 # 一開始就有可能出現多餘括號
-                brackets = 0
-                if sem_year >= 104:
-                    is_104_or_later = True
-                    time_list = list('0123456789') + ['10'] + list('ABCD')
+    @staticmethod
+    def get_course_fingerprint(course):
+        text = json.dumps(course, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def diff_courses(old_courses, new_courses):
+        # 比較新舊兩份課程資料，依序 yield 新增、修改的課程，最後才 yield 被刪
+        # 除的課程。new_courses 可以是 generator，下載的同時就能輸出結果。
+        def normalize(course):
+            if isinstance(course, Course):
+                course = course.to_dict()
+            course = json.loads(json.dumps(course))
+            course.pop('.__index__.', None)
+            return course
+
+        old = dict()
+        for course in old_courses:
+            if not course.get('not_found'):
+                course = normalize(course)
+                old[NolCrawler.get_course_key(course)] = course
+        seen = set()
+        for course in new_courses:
+            if course.get('not_found'):
+                continue
+            course = normalize(course)
+            key = NolCrawler.get_course_key(course)
+            seen.add(key)
+            if key not in old:
+                yield {'op': 'add', 'key': key, 'course': course}
+                continue
+            old_course = old[key]
+            if NolCrawler.get_course_fingerprint(old_course) == \
+                NolCrawler.get_course_fingerprint(course):
+                continue
+            changes = dict()
+            for field in set(old_course.keys()) | set(course.keys()):
+                if old_course.get(field) != course.get(field):
+                    changes[field] = [old_course.get(field), course.get(field)]
+            yield {'op': 'modify', 'key': key, 'changes': changes}
+        for key, course in old.items():
+            if key not in seen:
+                yield {'op': 'remove', 'key': key, 'course': course}
+
+    def make_course(self, row):
+        def raw(node):
+            return etree.tostring(node, encoding='utf-8').decode('utf-8')
+
+        def safe_str(x):
+            return '' if x is None else x.strip('\xa0')
+
+        def safe_int(x):
+            return 0 if safe_str(x) == '' else int(x)
+
+        def get_link(node):
+            if len(node) == 0 or node[0].tag != 'a':
+                return None
+            return node[0].get('href')
+
+        def get_link_text(node):
+            if len(node) == 0:
+                return ''
+            elif node[0].tag != 'a':
+                return safe_str(node.text)
+            return safe_str(node[0].text)
+
+        cells = list(row)
+        course = Course()
+        sem_year = self.sem_year
+        sem_index = self.sem_index
+
+        course['ser_no'] = safe_str(cells[0].text)
+        course['PRIVATE____dptname'] = safe_str(cells[1].text)
+        info_link = get_link(cells[4])
+        if info_link:
+            course['dpt_code'] = parse_qs(
+                urlparse(info_link).query)['dpt_code'][0]
+        else:
+            course['dpt_code'] = None
+
+        course['cou_code'] = safe_str(cells[7].text)
+        if sem_year >= 106 or (sem_year == 105 and sem_index >= 2):
+            course['credit'] = float(cells[6].text)
+        else:
+            course['credit'] = safe_int(cells[6].text)
+
+        course['co_select'] = safe_int(cells[11].text)
+        course['cou_cname'] = get_link_text(cells[4])
+        course['tea_cname'] = get_link_text(cells[10])
+        tea_link = get_link(cells[10])
+        if tea_link:
+            tea_link_parsed = parse_qs(urlparse(tea_link).query)
+            assert tea_link_parsed['op'][0] == 's2'
+            course['PRIVATE____teaid'] = tea_link_parsed['td'][0]
+        else:
+            course['PRIVATE____teaid'] = None
+
+        course['PRIVATE____video'] = get_link(cells[5])
+
+        time_clsrom_text = safe_str(''.join(cells[12].itertext()))
+        start_time = time.perf_counter()
+        course['time_clsrom'] = parse_time_clsrom(
+            sem_year >= 104, time_clsrom_text)
+        self.metrics.add_time('time_clsrom', time.perf_counter() - start_time)
+        course['PRIVATE____time_clsrom'] = time_clsrom_text
+
+        course['sel_code'] = safe_str(cells[9].text)
+        for text in cells[14].itertext():
+            if text is not None:
+                co_gmark = NolCrawler.co_gmark_regex.search(text)
+                if co_gmark is not None:
+                    course['co_gmark'] = safe_str(co_gmark.group(0))
                 else:
-                    is_104_or_later = False
-                    time_list = list('01234@56789ABCD')
-                time_dash = False # 可能會有像是 1-@ (等同 1234@) 這種表示法
-                day = clsrom = ''
-                unexpected_clsrom = ''
-                time = []
-                uncommitted_time = ''
-                for char in text:
-                    if char.isspace():
+                    course['co_gmark'] = None
+
+        # 整列的圖片只找一次，再用圖片的檔名判斷
+        images = [img.get('src') for img in NolCrawler.xpath_images(row)]
+        if 'images/cancel.gif' in images:
+            course['co_chg'] = '停開'
+        elif 'images/add.gif' in images:
+            course['co_chg'] = '加開'
+        elif 'images/chg.gif' in images:
+            course['co_chg'] = '異動'
+        else:
+            assert len(images) == 0 or 'images/courseweb.gif' in images
+            course['co_chg'] = None
+        assert 'co_chg' in course.keys()
+
+        course['comment'] = safe_str(''.join(cells[15].itertext()))
+        course['klass'] = safe_str(cells[3].text)
+
+        # CEIBA 連結要另外用 resolve_ceiba 查詢，這裡只先記下來
+        course['PRIVATE____ceiba'] = None
+        ceiba_link = get_link(cells[16])
+        if ceiba_link and ceiba_link.startswith('http://'):
+            ceiba_link = ceiba_link.replace('http', 'https', 1)
+
+        return course, ceiba_link if self.ceiba else None
+
+    def get_page(self, addr):
+        # 連線失敗已經在 perform 回報過，這裡回報 HTTP 狀態和網頁內容的結果
+        # 網頁分析成功後才存入 response_cache
+        host = RequestScheduler.get_host(NolCrawler.base_url)
+        user_args = self.get_page_args(addr)
+        data = BytesIO()
+        with self.metrics.timer('page'):
+            try:
+                with self.metrics.timer('request'):
+                    headers = NolCrawler.request(self.curl, data,
+                        NolCrawler.ssl_cipher_nol, user_args,
+                        cache=self.response_cache, scheduler=self.scheduler,
+                        metrics=self.metrics)
+                courses, ceiba_links = self.parse_page(addr, data)
+            except pycurl.error:
+                raise
+            except Exception as e:
+                self.scheduler.report(host, e)
+                raise
+            self.scheduler.report(host)
+            NolCrawler.store_response(self.response_cache,
+                NolCrawler.get_url(user_args), data, headers)
+            self.resolve_ceiba(ceiba_links)
+        return courses
+
+    def get_page_args(self, addr):
+        return {
+            'current_sem': self.semester,
+            'startrec': addr * NolCrawler.items_per_page,
+            'page_cnt': NolCrawler.items_per_page
+        }
+
+    def get_parser(self):
+        # lxml 的 parser 不能同時在不同執行緒中使用，背景下載的執行緒要用自己的
+        parser = getattr(self.local, 'parser', None)
+        if parser is None:
+            parser = etree.HTMLParser(encoding=NolCrawler.doc_encoding)
+            self.local.parser = parser
+        return parser
+
+    def parse_page(self, addr, data):
+        data.seek(0)
+        with self.metrics.timer('html'):
+            html = etree.parse(data, self.get_parser())
+            rows = NolCrawler.xpath_rows(html)
+            if len(rows) == 0 and len(NolCrawler.xpath_tables(html)) == 0:
+                raise Exception('NOL website down')
+            # 課程表格和上次下載時完全相同的話，直接使用上次的分析結果
+            digest = hashlib.sha1(b''.join(map(etree.tostring, rows))).hexdigest()
+        self.page_digests[addr] = digest
+        baseline = self.baseline.get(addr)
+        if baseline is not None and baseline[0] == digest:
+            self.metrics.count('baseline_hits')
+            return list(baseline[1]), []
+        courses = list()
+        ceiba_links = list()
+        with self.metrics.timer('rows'):
+            for course, ceiba_link in map(self.make_course, rows):
+                courses.append(course)
+                if ceiba_link:
+                    ceiba_links.append((course, ceiba_link))
+        # 有些頁面可能有缺項，但我們還是得補滿到剛好一頁
+        missing_count = NolCrawler.items_per_page - len(courses)
+        return courses + [not_found_course] * missing_count, ceiba_links
+
+    @staticmethod
+    def get_ceiba_url(link):
+        if NolCrawler.ceiba_url is None:
+            return link
+        parsed = urlparse(link)
+        return NolCrawler.ceiba_url + parsed.path + \
+            ('?' + parsed.query if parsed.query else '')
+
+    @staticmethod
+    def read_ceiba_location(curl, headers):
+        status = curl.getinfo(curl.RESPONSE_CODE)
+        if status == 404 or status == 200:
+            return None
+        NolCrawler.check_status(curl, 302)
+        location = NolCrawler.get_http_header(headers.getvalue(), b'Location')
+        if location.startswith('https://ceiba.ntu.edu.tw/login_test.php'):
+            return parse_qs(urlparse(location).query)['csn'][0]
+        elif location.startswith('https://ceiba.ntu.edu.tw/course/'):
+            return location.split('/')[4]
+        else:
+            raise Exception('Unexpected CEIBA URL {}'.format(location))
+
+    def get_unresolved_ceiba(self, ceiba_links):
+        # 回傳 ceiba_cache 中還沒有的連結，離線時直接丟出例外
+        missing = [link for course, link in ceiba_links
+                   if link not in self.ceiba_cache]
+        unresolved = sorted(set(missing))
+        self.metrics.count('ceiba_cache_hits', len(ceiba_links) - len(missing))
+        self.metrics.count('ceiba_cache_misses', len(missing))
+        if len(unresolved) > 0 and self.response_cache is not None and \
+            self.response_cache.offline:
+            raise CacheMissError(
+                '{} is not in the CEIBA cache'.format(unresolved[0]))
+        return unresolved
+
+    def fill_ceiba(self, ceiba_links):
+        for course, link in ceiba_links:
+            course['PRIVATE____ceiba'] = self.ceiba_cache.get(link)
+
+    def resolve_ceiba(self, ceiba_links):
+        # ceiba_links 是 (course, link) 的序列，可以一次包含很多頁的課程。還沒
+        # 查過的連結會同時送出請求，查到的結果存進 ceiba_cache 後再填回課程。
+        unresolved = self.get_unresolved_ceiba(ceiba_links)
+        if len(unresolved) > 0:
+            jobs = ((link, {
+                'data': BytesIO(),
+                'headers': BytesIO(),
+                'cipher': NolCrawler.ssl_cipher_ceiba,
+                'url_override': NolCrawler.get_ceiba_url(link)
+            }) for link in unresolved)
+            resolved = dict()
+            errors = list()
+            host = RequestScheduler.get_host(
+                NolCrawler.get_ceiba_url(unresolved[0]))
+            start_time = time.perf_counter()
+            curls = NolCrawler.acquire_curls(self.scheduler.get_concurrency(
+                host, self.ceiba_concurrency), self.debug)
+            try:
+                for link, args, curl, error in NolCrawler.request_multi(
+                        curls, jobs, self.scheduler, self.metrics):
+                    if error is not None:
+                        errors.append(Exception(error))
                         continue
-                    if brackets == 0 and state == 3 and char != '(':
-                        state = 0
-                    if state == 0: # day
-                        assert char in '一二三四五六日'
-                        day = char
-                        state += 1
-                    elif state == 1: # time
-                        # 104 學年度以後節課可能出現 10，所以一定都會用逗號分隔
-                        if is_104_or_later:
-                            if char == ',' or char == '(':
-                                if uncommitted_time != '':
-                                    assert uncommitted_time in time_list
-                                    time.append(uncommitted_time)
-                                    uncommitted_time = ''
-                                if char == '(':
-                                    brackets += 1
-                                    state += 1
-                                    continue
-                            else:
-                                uncommitted_time += char
-                        # 104 學年度以前的資料雖也改用逗號分隔，但是常常分得不
-                        # 正確，造成像是 1,-,@、8,9,1,0、9,,,A 這類錯誤。因此
-                        # 我們繼續使用舊的作法，忽略逗號。
-                        else:
-                            if char == ',':
-                                continue
-                            if char == '-':
-                                time_dash = True
-                                assert uncommitted_time == ''
-                                continue
-                            if char == '*':
-                                time.append('*')
-                                assert uncommitted_time == ''
-                                continue
-                            if char == '(':
-                                brackets += 1
-                                state += 1
-                                uncommitted_time = ''
-                                continue
-                            if char in time_list:
-                                if len(time) > 0:
-                                    time_prev = time_list.index(time[-1])
-                                    if uncommitted_time == '':
-                                        time_this = time_list.index(char)
-                                    else:
-                                        # 目前已知會出現兩位數的只有 10
-                                        assert uncommitted_time + char == '10'
-                                        # 重新對應回 A
-                                        time_this = time_list.index('A')
-                                        uncommitted_time = ''
-                                    # 檢查我們是不是遇到兩位數的。不過要注意時
-                                    # 間有可能沒排序，所以我們還是假設只可能出
-                                    # 現 10。
-                                    if time_this <= time_prev and char == '1':
-                                        uncommitted_time += char
-                                    else:
-                                        if time_dash:
-                                            assert len(time) == 1
-                                            time_this += 1
-                                            time = time_list[time_prev:time_this]
-                                        else:
-                                            time.append(time_list[time_this])
-                                else:
-                                    time.append(char)
-                            else:
-                                assert False
-                    elif state == 2: # clsrom
-                        if char == '(':
-                            brackets += 1
-                        elif char == ')':
-                            brackets -= 1
-                        if brackets > 0:
-                            clsrom += char
-                        elif brackets == 0:
-                            result.append((day, time, clsrom))
-                            day = clsrom = ''
-                            time = []
-                            state += 1
-                        else:
-                            assert False
-                    elif state == 3: # 多餘括號裡的資料先保存起來
-                        if char == '(':
-                            if brackets > 0:
-                                unexpected_clsrom += char
-                            brackets += 1
-                        elif char == ')':
-                            brackets -= 1
-                            if brackets > 0:
-                                unexpected_clsrom += char
-                        else:
-                            if brackets > 0:
-                                unexpected_clsrom += char
-                    else:
-                        assert False
-                # 括號可能沒有配對，這時候我們要直接先送出結果，不經過 assert
-                if clsrom.endswith(')') and brackets > 0:
-                    result.append((day, time, clsrom))
-                    return result
-                # 可能沒有時間，只有教室，我們手動填空直接回傳
-                if day == '' and time == [] and clsrom == '' and \
-                    unexpected_clsrom != '' and len(result) == 0:
-                    result.append(('', '', unexpected_clsrom))
-                    return result
-                # 如果教室全部都是「請洽系所辦」，那就從前面多出來的挖
-                if list(map(lambda r: r[2], result)) == ['請洽系所辦'] * len(result):
-                    if unexpected_clsrom != '':
-                        for i in range(0, len(result)):
-                            result[i] = (result[i][0], result[i][1], unexpected_clsrom)
-                assert day == '' and time == [] and clsrom == '' and brackets == 0
-                return result
-
-            time_clsrom_text = safe_str(''.join(cells[12].itertext()))
-            course['time_clsrom'] = read_time_clsrom(time_clsrom_text)
-            course['PRIVATE____time_clsrom'] = time_clsrom_text
-
-            course['sel_code'] = safe_str(cells[9].text)
-            for text in cells[14].itertext():
-                if text is not None:
-                    co_gmark = re.search('A[1-8]+\**', text)
-                    if co_gmark is not None:
-                        course['co_gmark'] = safe_str(co_gmark.group(0))
-                    else:
-                        course['co_gmark'] = None
-
-            if len(row.xpath('.//img[@src="images/cancel.gif"]')) > 0:
-                course['co_chg'] = '停開'
-            elif len(row.xpath('.//img[@src="images/add.gif"]')) > 0:
-                course['co_chg'] = '加開'
-            elif len(row.xpath('.//img[@src="images/chg.gif"]')) > 0:
-                course['co_chg'] = '異動'
-            else:
-                assert len(row.xpath('.//img')) == 0 or \
-                    len(row.xpath('.//img[@src="images/courseweb.gif"]')) > 0
-                course['co_chg'] = None
-            assert 'co_chg' in course.keys()
-
-            course['comment'] = safe_str(''.join(cells[15].itertext()))
-            course['klass'] = safe_str(cells[3].text)
-
-            ceiba_link = get_link(cells[16])
-            if self.ceiba and ceiba_link:
-                if ceiba_link.startswith('http://'):
-                    ceiba_link = ceiba_link.replace('http', 'https', 1)
-                headers = BytesIO()
-                self.curl.setopt(self.curl.HEADERFUNCTION, headers.write)
+                    try:
+                        resolved[link] = NolCrawler.read_ceiba_location(
+                            curl, args['headers'])
+                    except Exception as e:
+                        self.scheduler.report(RequestScheduler.get_host(
+                            args['url_override']), e)
+                        errors.append(e)
+                        continue
+                    self.scheduler.report(RequestScheduler.get_host(
+                        args['url_override']))
+            finally:
+                NolCrawler.release_curls(curls)
+                self.metrics.add_time('ceiba', time.perf_counter() - start_time)
+            self.ceiba_cache.update(resolved)
+            self.ceiba_cache.save_if_needed()
+            if len(errors) > 0:
+                raise errors[0]
+        self.fill_ceiba(ceiba_links)
+
+    def get_course(self, index):
+        if index < 0:
+            return None
+        courses = self.load_page(NolCrawler.get_cache_addr(index))
+        return courses[index % NolCrawler.items_per_page]
+
+    def iter_courses(self, start=0, stop=None, retry=None):
+        # 一次處理一頁，依序 yield (index, course)，stop 省略表示到最後一門課。
+        # 下載或分析頁面失敗時會呼叫 retry(index, exception)，index 是這頁第
+        # 一門要取得的課程，回傳 True 就重試這頁；沒有 retry 時直接丟出例外。
+        # 重試前要等 scheduler 允許，失敗不一定有送出請求（例如 cache 中的網頁
+        # 分析失敗），只在 perform 中等待的話會變成不停重試。
+        if stop is None:
+            if self.course_count is None:
+                self.course_count = NolCrawler.get_course_count(self.semester,
+                    self.response_cache)
+            stop = self.course_count
+        index = max(start, 0)
+        # 背景預先下載也不要超過 stop 所在的頁面，nol_bulk 的每個分段只下載
+        # 自己範圍內的頁面
+        last_addr = NolCrawler.get_cache_addr(stop - 1)
+        # 結束或中斷時把還沒寫入的 CEIBA 查詢結果存起來
+        try:
+            while index < stop:
+                addr = NolCrawler.get_cache_addr(index)
                 try:
-                    NolCrawler.request(self.curl, BytesIO(),
-                        NolCrawler.ssl_cipher_ceiba,
-                        url_override=ceiba_link, expected_status=302)
+                    courses = self.load_page(addr, sequential=True,
+                        last_addr=last_addr)
+                except CacheMissError:
+                    raise
                 except Exception as e:
-                    if self.curl.getinfo(self.curl.RESPONSE_CODE) == 404 or \
-                        self.curl.getinfo(self.curl.RESPONSE_CODE) == 200:
-                        course['PRIVATE____ceiba'] = None
-                    else:
-                        raise Exception(str(e))
-                else:
-                    location = get_http_header(headers.getvalue(), b'Location')
-                    if location.startswith('https://ceiba.ntu.edu.tw/login_test.php'):
-                        course['PRIVATE____ceiba'] = parse_qs(
-                            urlparse(location).query)['csn'][0]
-                    elif location.startswith('https://ceiba.ntu.edu.tw/course/'):
-                        course['PRIVATE____ceiba'] = location.split('/')[4]
-                    else:
-                        raise Exception('Unexpected CEIBA URL {}'.format(location))
-            else:
-                course['PRIVATE____ceiba'] = None
-            assert 'PRIVATE____ceiba' in course.keys()
+                    if retry is None or not retry(index, e):
+                        raise
+                    self.metrics.count('retries')
+                    self.scheduler.acquire(RequestScheduler.get_host(
+                        NolCrawler.base_url))
+                    continue
+                page_stop = min((addr + 1) * NolCrawler.items_per_page, stop)
+                self.metrics.count('rows', page_stop - index)
+                for page_index in range(index, page_stop):
+                    yield page_index, \
+                        courses[page_index % NolCrawler.items_per_page]
+                index = page_stop
+        finally:
+            self.ceiba_cache.save()
 
-            return course
+    def load_page(self, addr, sequential=False, last_addr=None):
+        # 取得一整頁的課程，get_course 和 iter_courses 都經過這裡，所以 cache、
+        # 背景預先下載等同時下載的機制都接在這一層。last_addr 是預先下載的最後
+        # 一頁，省略表示到這學期的最後一頁
+        # 要的頁面正在背景下載的話就等它下載完，不要重複下載
+        thread = self.readahead_thread
+        if thread is not None and addr in self.readahead_pages:
+            thread.join()
+        courses = self.cache.load(addr, self.get_page, addr)
+        if self.readahead > 0:
+            # 只有循序讀取時才預先下載後面的頁面
+            if sequential or (self.last_addr is not None and \
+                (addr == self.last_addr or addr == self.last_addr + 1)):
+                stop = addr + self.readahead + 1
+                if last_addr is not None:
+                    stop = min(stop, last_addr + 1)
+                self.start_readahead(addr + 1, stop)
+            self.last_addr = addr
+        return courses
+
+    def start_readahead(self, first, stop):
+        thread = self.readahead_thread
+        if thread is not None and thread.is_alive():
+            return
+        # 不要下載超過最後一頁的頁面
+        if self.course_count is None:
+            self.course_count = NolCrawler.get_course_count(self.semester,
+                self.response_cache)
+        stop = min(stop, NolCrawler.get_cache_addr(
+            self.course_count + NolCrawler.items_per_page - 1))
+        pages = set(addr for addr in range(first, stop)
+                    if not self.cache.contains(addr))
+        if len(pages) == 0:
+            return
+        items = NolCrawler.items_per_page
+        self.readahead_pages = pages
+        self.readahead_thread = threading.Thread(target=self.prefetch,
+            args=(min(pages) * items, (max(pages) + 1) * items, len(pages)),
+            daemon=True)
+        self.readahead_thread.start()
+
+    def iter_pages(self, addrs, concurrency=4, retry=None):
+        # 同時下載 addrs 中的頁面，每完成一頁就 yield (addr, courses)。失敗的頁面
+        # 會呼叫 retry(index, exception)，回傳 True 就排到最後面重試，所以頁面不
+        # 一定會依照順序完成。頁面中可能有範圍外的課程，所以 metrics 的 rows 要由
+        # 呼叫者自己計算。
+        pending = list(addrs)
+        concurrency = max(1, min(concurrency, self.cache.size))
+        # 結束或中斷時把還沒寫入的 CEIBA 查詢結果存起來
+        try:
+            while len(pending) > 0:
+                batch = pending[:concurrency]
+                del pending[:concurrency]
+                self.prefetch_pages(batch, concurrency)
+                for addr in batch:
+                    # 同時下載失敗的頁面再單獨下載一次，才能取得錯誤的原因
+                    try:
+                        courses = self.cache.load(addr, self.get_page, addr)
+                    except CacheMissError:
+                        raise
+                    except Exception as e:
+                        if retry is None or \
+                            not retry(addr * NolCrawler.items_per_page, e):
+                            raise
+                        self.metrics.count('retries')
+                        self.scheduler.acquire(RequestScheduler.get_host(
+                            NolCrawler.base_url))
+                        pending.append(addr)
+                        continue
+                    yield addr, courses
+        finally:
+            self.ceiba_cache.save()
 
-        def get_page(index):
-            page_number = int(index / NolCrawler.items_per_page)
-            page_startrec = page_number * NolCrawler.items_per_page
-            data = BytesIO()
+    def prefetch(self, start, stop, concurrency=4):
+        # 同時下載 [start, stop) 範圍內的課程所在的頁面並存入 cache，已經在
+        # cache 裡的頁面會略過。失敗的頁面不會存入 cache，之後呼叫 get_course
+        # 時會重新下載，錯誤也會在那時候才回報。
+        if stop <= start:
+            return
+        self.prefetch_pages(range(NolCrawler.get_cache_addr(start),
+            NolCrawler.get_cache_addr(stop - 1) + 1), concurrency)
+
+    def prefetch_pages(self, addrs, concurrency=4):
+        pages = dict()
+        ceiba_links = list()
+        jobs = list()
+        for addr in addrs:
+            if self.cache.contains(addr):
+                continue
             args = {
-                'current_sem': self.semester,
-                'startrec': page_startrec
+                'data': BytesIO(),
+                'cipher': NolCrawler.ssl_cipher_nol,
+                'user_args': self.get_page_args(addr)
             }
-            NolCrawler.request(self.curl, data, NolCrawler.ssl_cipher_nol, args)
-            data.seek(0)
-            html = etree.parse(data, etree.HTMLParser(encoding=NolCrawler.doc_encoding))
-            rows = html.xpath('/html/body/table[4]/tr[position() > 1]')
-            if len(rows) == 0 and len(html.xpath('/html/body/table')) == 0:
-                raise Exception('NOL website down')
-            courses = list(map(make_course, rows))
-            # 有些頁面可能有缺項，但我們還是得補滿到剛好一頁
-            missing_count = NolCrawler.items_per_page - len(courses)
-            return courses + [ {'not_found': True} ] * missing_count
+            if self.response_cache is not None:
+                try:
+                    body, args['request_headers'] = self.response_cache.lookup(
+                        NolCrawler.get_url(args['user_args']))
+                except Exception:
+                    continue
+                self.metrics.count('response_cache_hits' if body is not None
+                                   else 'response_cache_misses')
+                if body is not None:
+                    try:
+                        pages[addr] = self.parse_page(addr, BytesIO(body))
+                        ceiba_links += pages[addr][1]
+                    except Exception:
+                        pass
+                    continue
+                args['headers'] = BytesIO()
+            jobs.append((addr, args))
+        host = RequestScheduler.get_host(NolCrawler.base_url)
+        start_time = time.perf_counter()
+        curls = NolCrawler.acquire_curls(
+            self.scheduler.get_concurrency(host, concurrency), self.debug)
+        try:
+            for addr, args, curl, error in NolCrawler.request_multi(
+                    curls, jobs, self.scheduler, self.metrics):
+                if error is not None:
+                    continue
+                url = NolCrawler.get_url(args['user_args'])
+                headers = None
+                try:
+                    if self.response_cache is None:
+                        NolCrawler.check_status(curl)
+                    elif NolCrawler.finish_cached_request(self.response_cache,
+                            url, curl, args['data']):
+                        self.metrics.count('response_cache_revalidated')
+                    else:
+                        headers = args['headers']
+                    pages[addr] = self.parse_page(addr, args['data'])
+                    ceiba_links += pages[addr][1]
+                except Exception as e:
+                    self.scheduler.report(host, e)
+                    continue
+                self.scheduler.report(host)
+                NolCrawler.store_response(self.response_cache, url,
+                    args['data'], headers)
+        finally:
+            NolCrawler.release_curls(curls)
+            self.metrics.add_time('prefetch', time.perf_counter() - start_time)
+        # 所有頁面的 CEIBA 連結一起查詢，有連結查詢失敗的頁面就不存入 cache
+        try:
+            self.resolve_ceiba(ceiba_links)
+        except Exception:
+            pass
+        for addr, (courses, page_ceiba_links) in pages.items():
+            if all(link in self.ceiba_cache for course, link in page_ceiba_links):
+                self.fill_ceiba(page_ceiba_links)
+                self.cache.store(addr, courses)
 
-        if index < 0:
-            return None
-        courses = self.cache.load(NolCrawler.get_cache_addr(index), get_page, index)
-        return courses[index % NolCrawler.items_per_page]
+    def get_metrics(self):
+        # metrics 的統計結果，再加上 cache 命中率、每秒處理的課程數和 scheduler
+        # 目前的狀態
+        result = self.metrics.snapshot()
+        counters = result['counters']
+
+        def ratio(hits, misses):
+            total = counters.get(hits, 0) + counters.get(misses, 0)
+            return counters.get(hits, 0) / total if total > 0 else None
+
+        page_cache = self.cache.stats()
+        lookups = page_cache['hits'] + page_cache['misses']
+        result['page_cache'] = page_cache
+        result['hit_rates'] = {
+            'page_cache': page_cache['hits'] / lookups if lookups > 0 else None,
+            'response_cache': ratio('response_cache_hits', 'response_cache_misses'),
+            'ceiba_cache': ratio('ceiba_cache_hits', 'ceiba_cache_misses')
+        }
+        result['rows_per_sec'] = counters.get('rows', 0) / result['elapsed'] \
+            if result['elapsed'] > 0 else 0
+        result['scheduler'] = self.scheduler.stats()
+        return result
+
+    def set_baseline(self, pages):
+        # pages 是 {addr: (digest, courses)}，通常是上次下載時的 page_digests 和
+        # 課程資料。之後下載到內容相同的頁面就不再分析也不查詢 CEIBA 連結。
+        self.baseline = {addr: (digest, [Course.from_dict(c) for c in courses])
+                         for addr, (digest, courses) in pages.items()}
 
     def flush_cache(self, index):
         self.cache.invalidate(NolCrawler.get_cache_addr(index))
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# vim: set ts=4 sts=4 sw=4 et:
+
+from nol_app import pop_flag, pop_option
+from nol_lib import CeibaCache, ResponseCache
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from urllib.parse import urlparse, parse_qs
+from sys import argv, stderr, stdout
+import random
+import threading
+import time
+
+# 在本機模擬 nol 和 CEIBA，網頁內容來自 nol_app.py --cache-dir 存下來的 cache，
+# CEIBA 連結的查詢結果則來自 --ceiba-cache 的檔案。NolCrawler.base_url 和
+# NolCrawler.ceiba_url 指向這裡就可以在不連線的情況下測量整個下載流程。
+
+def get_page_key(query):
+    return tuple(query.get(name, [None])[0]
+                 for name in ('current_sem', 'startrec', 'page_cnt'))
+
+def load_nol_pages(cache_dir):
+    # 以 (current_sem, startrec, page_cnt) 當作 key，沒有 startrec 的是學期首頁
+    pages = dict()
+    paths = set()
+    for url, body in ResponseCache(cache_dir, offline=True).entries():
+        parsed = urlparse(url)
+        paths.add(parsed.path)
+        pages[get_page_key(parse_qs(parsed.query))] = body
+    return pages, paths
+
+def load_ceiba_links(path):
+    # CEIBA 連結只看路徑和參數，不管原本是哪個主機
+    links = dict()
+    if path:
+        for link, csn in CeibaCache(path).links.items():
+            parsed = urlparse(link)
+            links[parsed.path + ('?' + parsed.query if parsed.query else '')] = csn
+    return links
+
+
+class ReplayHandler(BaseHTTPRequestHandler):
+    # 使用 HTTP/1.1，讓 NolCrawler 可以重複使用連線
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+    def send_body(self, status, body=b'', headers=[]):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        delay = server.latency + random.uniform(0, server.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        with server.lock:
+            server.requests += 1
+        parsed = urlparse(self.path)
+        if parsed.path in server.nol_paths:
+            self.reply_nol(parse_qs(parsed.query))
+        else:
+            self.reply_ceiba(self.path)
+
+    def reply_nol(self, query):
+        server = self.server
+        # 只在課程頁面注入錯誤，回應的是沒有任何表格的網頁，和 nol 故障時一樣
+        if 'startrec' in query and random.random() < server.error_rate:
+            self.send_body(200, b'<html><body>down</body></html>',
+                [('Content-Type', 'text/html; charset=big5')])
+            return
+        body = server.nol_pages.get(get_page_key(query))
+        if body is None:
+            self.send_body(404)
+            return
+        self.send_body(200, body, [('Content-Type', 'text/html; charset=big5')])
+
+    def reply_ceiba(self, path):
+        server = self.server
+        if random.random() < server.error_rate:
+            self.send_body(503)
+            return
+        csn = server.ceiba_links.get(path)
+        if csn is None:
+            self.send_body(404)
+            return
+        self.send_body(302, headers=[
+            ('Location', 'https://ceiba.ntu.edu.tw/course/{}/'.format(csn))])
+
+
+class ReplayServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, address, cache_dir, ceiba_cache=None, latency=0,
+                 jitter=0, error_rate=0, verbose=False):
+        HTTPServer.__init__(self, address, ReplayHandler)
+        self.nol_pages, self.nol_paths = load_nol_pages(cache_dir)
+        self.ceiba_links = load_ceiba_links(ceiba_cache)
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.verbose = verbose
+        self.requests = 0
+        self.lock = threading.Lock()
+
+    def get_url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+if __name__ == '__main__':
+    try:
+        argv.index('--help')
+        print('Usage: {} [--port N] [--ceiba-cache FILE] [--latency SECONDS] '
+              '[--jitter SECONDS] [--error-rate P] [--verbose] '
+              'CACHE_DIR'.format(argv[0]))
+        exit(0)
+    except ValueError:
+        pass
+
+    port = int(pop_option('--port', 8000))
+    ceiba_cache = pop_option('--ceiba-cache', None)
+    latency = float(pop_option('--latency', 0))
+    jitter = float(pop_option('--jitter', 0))
+    error_rate = float(pop_option('--error-rate', 0))
+    verbose = pop_flag('--verbose')
+    if len(argv) < 2:
+        print('Usage: {} CACHE_DIR'.format(argv[0]), file=stderr)
+        exit(1)
+
+    # 和 NolCrawler 一樣，預設使用 cache 目錄中的 CEIBA 查詢結果
+    if ceiba_cache is None:
+        ceiba_cache = ResponseCache(argv[1], offline=True).get_ceiba_cache_path()
+    server = ReplayServer(('127.0.0.1', port), argv[1], ceiba_cache,
+        latency, jitter, error_rate, verbose)
+    # 第一行輸出伺服器的網址，nol_bench.py 會讀取它
+    print(server.get_url())
+    stdout.flush()
+    print('{} pages, {} CEIBA links'.format(
+        len(server.nol_pages), len(server.ceiba_links)), file=stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass